@@ -0,0 +1,300 @@
+"""
+Drives the API with concurrent clients against a synthetic trivia dataset
+and reports the latency percentiles and throughput of each scenario:
+  - paging: walks GET /questions page after page through next_cursor
+  - search: POST /questions/searchTerm with a random word of the dataset
+  - category: walks GET /categories/<id>/questions of a random category
+  - quiz: plays /quizzes games of --rounds rounds
+
+The dataset (--questions across --categories, generated from --seed so
+two runs get the same rows) goes into a throwaway SQLite database, or into
+--database, where it is reused with --reuse if already there. Every
+scenario runs at each --concurrency through the Flask test client and a
+threaded WSGI server, or against an already running server with --url.
+The JSON report, tagged with the current commit, can be kept with --output
+and compared between commits. From the backend folder:
+
+    python benchmarks/bench_load.py --questions 1000000 --concurrency 1,8,32 --output before.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app
+from models import db, Question, Category
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'bu', 'da', 'fe', 'gi', 'ho', 'ju', 'pe')
+SCENARIOS = ('paging', 'search', 'category', 'quiz')
+
+
+def vocabulary(rng, size=2000):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate(questions, categories, seed, batch=10000):
+    rng = random.Random(seed)
+    words = vocabulary(rng)
+    db.session.execute(Category.__table__.insert(), [
+        {'id': i, 'type': 'Category {}'.format(i)} for i in range(1, categories + 1)
+    ])
+    for start in range(0, questions, batch):
+        db.session.execute(Question.__table__.insert(), [
+            {
+                'question': 'What is the {} of the {} {}?'.format(*rng.sample(words, 3)),
+                'answer': ' '.join(rng.sample(words, 2)).title(),
+                'category': rng.randint(1, categories),
+                'difficulty': rng.randint(1, 5),
+            }
+            for _ in range(start, min(start + batch, questions))
+        ])
+    db.session.commit()
+    return words
+
+
+class TestClient:
+    """Requests through the Flask test client, in the benchmark's process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        res = self.client.get(path)
+        return res.status_code, res.get_json()
+
+    def post(self, path, body):
+        res = self.client.post(path, json=body)
+        return res.status_code, res.get_json()
+
+
+class HTTPClient:
+    """Requests over one keep-alive HTTP connection per client"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                headers = {'Content-Type': 'application/json'} if body is not None else {}
+                self.connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+                res = self.connection.getresponse()
+                data = res.read()
+                if res.getheader('Connection', '').lower() == 'close':
+                    self.connection.close()
+                    self.connection = None
+                return res.status, json.loads(data) if data else None
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, body):
+        return self.request('POST', path, body)
+
+
+class Player:
+    """State of one client across its operations: the page it walks, the game it plays"""
+
+    def __init__(self, client, rng, words, categories, rounds):
+        self.client = client
+        self.rng = rng
+        self.words = words
+        self.categories = categories
+        self.rounds = rounds
+        self.next_path = None
+        self.previous_questions = []
+        self.quiz_category = 0
+
+    def walk(self, first_page):
+        status, data = self.client.get(self.next_path or first_page)
+        cursor = data.get('next_cursor') if status == 200 else None
+        self.next_path = '{}{}cursor={}'.format(
+            first_page, '&' if '?' in first_page else '?', cursor) if cursor else None
+        return status
+
+    def paging(self):
+        return self.walk('/questions')
+
+    def search(self):
+        status, data = self.client.post('/questions/searchTerm', {'searchTerm': self.rng.choice(self.words)})
+        return status
+
+    def category(self):
+        if self.next_path is None:
+            self.category_path = '/categories/{}/questions'.format(self.rng.randint(1, self.categories))
+        return self.walk(self.category_path)
+
+    def quiz(self):
+        if not self.previous_questions:
+            self.quiz_category = self.rng.randint(0, self.categories)
+        status, data = self.client.post('/quizzes', {
+            'previous_questions': self.previous_questions,
+            'quiz_category': {'id': self.quiz_category},
+        })
+        question = data.get('question') if status == 200 else None
+        if question is None or len(self.previous_questions) + 1 >= self.rounds:
+            self.previous_questions = []
+        else:
+            self.previous_questions.append(question['id'])
+        return status
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+
+def run_scenario(scenario, make_client, concurrency, requests, options):
+    per_player = max(1, requests // concurrency)
+    samples = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+
+    def play(index):
+        player = Player(make_client(), random.Random(options.seed + index), options.words,
+                        options.categories, options.rounds)
+        operation = getattr(player, scenario)
+        operation()
+        for _ in range(per_player):
+            started = time.perf_counter()
+            try:
+                status = operation()
+            except Exception:
+                status = None
+            samples[index].append((time.perf_counter() - started) * 1000)
+            if status not in (200, 404):
+                errors[index] += 1
+
+    threads = [threading.Thread(target=play, args=(index,)) for index in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(sample for player_samples in samples for sample in player_samples)
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3),
+        },
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', help='database URI, a throwaway SQLite file by default')
+    parser.add_argument('--reuse', action='store_true', help='keep the questions already in --database')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario and concurrency')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds of a quiz game')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--transports', default='test_client,wsgi')
+    parser.add_argument('--url', help='benchmark the server running at this URL instead')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--output', help='also write the report to this file')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': options.database or 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+            'RESPONSE_CACHE': 'lru' if options.response_cache else None,
+        })
+        with app.app_context():
+            existing = Question.query.count()
+            if options.reuse and existing >= options.questions:
+                options.words = vocabulary(random.Random(options.seed))
+                options.categories = Category.query.count()
+            elif existing:
+                parser.error('the database already holds {} questions, pass --reuse or an empty database'.format(existing))
+            else:
+                started = time.perf_counter()
+                options.words = generate(options.questions, options.categories, options.seed)
+                print('generated {} questions in {:.1f}s'.format(options.questions, time.perf_counter() - started),
+                      file=sys.stderr)
+            dialect = db.engine.dialect.name
+
+        if options.url:
+            transports = {'url': lambda: HTTPClient(options.url)}
+        else:
+            WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:{}'.format(server.server_port)
+            transports = {
+                'test_client': lambda: TestClient(app),
+                'wsgi': lambda: HTTPClient(url),
+            }
+            transports = {name: transports[name] for name in options.transports.split(',')}
+
+        results = []
+        for scenario in options.scenarios.split(','):
+            for name, make_client in transports.items():
+                for concurrency in (int(value) for value in options.concurrency.split(',')):
+                    result = run_scenario(scenario, make_client, concurrency, options.requests, options)
+                    results.append(dict(scenario=scenario, transport=name, concurrency=concurrency, **result))
+                    print('{:<9} {:<12} x{:<4} p50 {:>9.3f} ms  p99 {:>9.3f} ms  {:>8.1f} req/s'.format(
+                        scenario, name, concurrency, result['latency_ms']['p50'],
+                        result['latency_ms']['p99'], result['throughput_rps']), file=sys.stderr)
+
+        if not options.url:
+            server.shutdown()
+
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'database': dialect,
+        'questions': options.questions,
+        'categories': options.categories,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Compares the latency of page 1 and a deep page of GET /questions for
+  - the old offset slicing (load every row, format it, slice out 10)
+  - LIMIT/OFFSET pushed into the query (?page=)
+  - keyset seeking with a signed cursor (?cursor=)
+
+Runs against a throwaway SQLite database, from the backend folder:
+
+    python benchmarks/bench_pagination.py --rows 100010 --page 10000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from flaskr.pagination import dump_cursor
+from models import db, Question, Category
+
+
+def seed(rows, categories=6, batch=10000):
+    db.session.execute(Category.__table__.insert(), [
+        {'id': i, 'type': 'Category {}'.format(i)} for i in range(1, categories + 1)
+    ])
+    for start in range(0, rows, batch):
+        db.session.execute(Question.__table__.insert(), [
+            {
+                'question': 'Synthetic question {}?'.format(i),
+                'answer': 'Answer {}'.format(i),
+                'category': i % categories + 1,
+                'difficulty': i % 5 + 1,
+            }
+            for i in range(start, min(start + batch, rows))
+        ])
+    db.session.commit()
+
+
+def legacy_offset_slicing(page):
+    selection = Question.query.order_by(Question.id).all()
+    start = (page - 1) * QUESTIONS_PER_PAGE
+    questions = [question.format() for question in selection]
+    return questions[start:start + QUESTIONS_PER_PAGE]
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=100010)
+    parser.add_argument('--page', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+            # every case requests the same URL repeatedly: measure the queries, not cache hits
+            'RESPONSE_CACHE': None,
+        })
+        client = app.test_client()
+        with app.app_context():
+            seed(args.rows)
+            before_deep_page = Question.query.order_by(Question.id).offset(
+                (args.page - 1) * QUESTIONS_PER_PAGE - 1).first()
+            with app.test_request_context():
+                deep_cursor = dump_cursor(before_deep_page, (Question.id,), 'questions')
+
+            results = {'rows': args.rows, 'deep_page': args.page, 'median_ms': {
+                'offset_slicing': {
+                    'page_1': timed(lambda: legacy_offset_slicing(1), args.repeat),
+                    'deep_page': timed(lambda: legacy_offset_slicing(args.page), args.repeat),
+                },
+                'limit_offset': {
+                    'page_1': timed(lambda: client.get('/questions?page=1'), args.repeat),
+                    'deep_page': timed(lambda: client.get('/questions?page={}'.format(args.page)), args.repeat),
+                },
+                'cursor': {
+                    'page_1': timed(lambda: client.get('/questions'), args.repeat),
+                    'deep_page': timed(lambda: client.get('/questions?cursor=' + deep_cursor), args.repeat),
+                },
+            }}
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
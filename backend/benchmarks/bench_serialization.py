@@ -0,0 +1,75 @@
+"""
+Measures how many question rows per second are loaded and encoded by
+  - the ORM path: Question entities, Question.format() and flask.jsonify
+  - the compact path: selected columns, Question.format_row() and the
+    app jsonify, with the standard library and with orjson if installed
+
+Runs against a throwaway SQLite database, from the backend folder:
+
+    python benchmarks/bench_serialization.py --rows 50000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask
+
+from bench_pagination import seed
+from flaskr import create_app
+from flaskr import serialization
+from models import Question
+
+
+def orm_path():
+    questions = Question.query.order_by(Question.id).all()
+    return flask.jsonify({'questions': [question.format() for question in questions]})
+
+
+def compact_path():
+    rows = Question.query.with_entities(*Question.columns()).order_by(Question.id).all()
+    return serialization.jsonify({'questions': [Question.format_row(row) for row in rows]})
+
+
+def rows_per_second(fn, rows, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return int(rows / statistics.median(samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+        })
+        with app.app_context():
+            seed(args.rows)
+
+        results = {'rows': args.rows, 'rows_per_second': {}}
+        with app.test_request_context():
+            results['rows_per_second']['orm_format_jsonify'] = rows_per_second(orm_path, args.rows, args.repeat)
+            app.config['JSON_ENCODER'] = 'json'
+            results['rows_per_second']['columns_format_row_json'] = rows_per_second(compact_path, args.rows, args.repeat)
+            if serialization.orjson is not None:
+                app.config['JSON_ENCODER'] = 'orjson'
+                results['rows_per_second']['columns_format_row_orjson'] = rows_per_second(
+                    compact_path, args.rows, args.repeat)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,152 @@
+import time
+_import_started = time.perf_counter()
+
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, g, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
+from models import setup_db, create_schema, database_path, replica_paths, db, Question, Category
+from pooling import pool_metrics
+from routing import read_only
+from settings import SECRET_KEY, DEFAULT_SECRET_KEY, DB_CREATE_ALL, LAZY_STARTUP
+from .pagination import paginate
+from .quiz import QuizPool, quiz_count, start_session, load_session, next_in_session
+from .search import create_search_engine, search_questions, InvertedIndexSearch
+from .suggest import PrefixIndex
+from .categories import CategoryCache
+from .conditional import DataVersion, cache_control
+from .response_cache import create_response_cache, response_cache_key
+from .bulk import import_questions, export_questions
+from .streaming import stream_questions
+from .serialization import jsonify
+from .metrics import RequestMetrics, start_request, finish_request
+from .stats import total_questions, question_stats
+from .startup import StartupTimings
 
 QUESTIONS_PER_PAGE = 10
+SUGGESTIONS_PER_PREFIX = 10
 CATEGORIES_PER_PAGE = 10
 
-def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return current_questions
-
-def paginate_categories(request, selection):
+# `?return=minimal` or `Prefer: return=minimal` asks a write endpoint to skip
+# the page of questions and the total it otherwise sends back
+def wants_minimal_response(request):
+    return (request.args.get('return') == 'minimal'
+            or 'return=minimal' in request.headers.get('Prefer', ''))
+
+# `?page_size=all&stream=1` sends a whole listing as a chunked response;
+# a whole listing is never built in memory, so it requires stream=1
+def wants_streamed_listing(request):
+    if request.args.get('page_size') != 'all':
+        return False
+    if request.args.get('stream') != '1':
+        abort(400)
+    return True
+
+def paginate_questions(request, selection, keys=(Question.id,), scope='questions'):
+    selection = selection.with_entities(*Question.columns())
+    page, next_cursor = paginate(request, selection, keys, QUESTIONS_PER_PAGE, scope)
+    current_questions = [Question.format_row(row) for row in page]
+
+    return current_questions, next_cursor
+
+# categories come from the CategoryCache, so they are paginated in memory
+def paginate_categories(request, categories):
     page = request.args.get('page', 1, type=int)
+    if page < 1:
+        return []
     start = (page - 1) * CATEGORIES_PER_PAGE
     end = start + CATEGORIES_PER_PAGE
 
-    categories = [categorie.format() for categorie in selection]
-    current_categories = categories[start:end]
+    current_categories = [
+        {'id': category_id, 'type': type}
+        for category_id, type in list(categories.items())[start:end]
+    ]
 
     return current_categories
 
+# Drops what an app keeps in memory between requests, for an app reused
+# across tests whose data changed underneath it
+def reset_state(app):
+    app.extensions['quiz_pool'].reset()
+    app.extensions['suggest'].reset()
+    app.extensions['categories'].invalidate()
+    app.extensions['data_version'].bump()
+    if isinstance(app.extensions['search'], InvertedIndexSearch):
+        app.extensions['search'].reset()
+    if app.extensions['response_cache'] is not None:
+        app.extensions['response_cache'].invalidate()
+
 def create_app(test_config=None):
+    started = time.perf_counter()
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(SECRET_KEY=SECRET_KEY)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY and not (app.debug or app.testing):
+        # anyone can sign a cursor with the public default key
+        app.logger.warning('SECRET_KEY is the default one: set SECRET_KEY in the environment')
+    app.extensions['startup'] = StartupTimings(IMPORT_SECONDS)
+    startup = app.extensions['startup']
+    lazy = app.config.get('LAZY_STARTUP', LAZY_STARTUP)
+
+    with startup.phase('setup_db'):
+        setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path),
+                 app.config.get('SQLALCHEMY_REPLICA_URIS', replica_paths))
+    if lazy and app.config.get('DB_CREATE_ALL', DB_CREATE_ALL):
+        startup.defer('create_schema', create_schema)
+    app.extensions['quiz_pool'] = QuizPool(app.config.get('QUIZ_POOL_TTL', 300))
+    with startup.phase('search'):
+        app.extensions['search'] = create_search_engine(app, prepare=not lazy)
+    if lazy:
+        startup.defer('prepare_search', app.extensions['search'].prepare)
+    app.extensions['suggest'] = PrefixIndex(app.config.get('SUGGEST_INDEX_TTL', 300))
+    app.extensions['categories'] = CategoryCache(app.config.get('CATEGORY_CACHE_TTL', 300))
+    category_cache = app.extensions['categories']
+    app.extensions['data_version'] = DataVersion(app.config.get('DATA_VERSION_WINDOW', 60))
+    data_version = app.extensions['data_version']
+    app.extensions['response_cache'] = create_response_cache(app.config)
+    response_cache = app.extensions['response_cache']
+    app.extensions['metrics'] = RequestMetrics()
+    metrics = app.extensions['metrics']
+
+    # Registered first, so the timer runs before the cache hooks below and
+    # the recording after every other after_request hook
+    @app.before_request
+    def start_request_metrics():
+        start_request()
+
+    @app.after_request
+    def record_request_metrics(response):
+        return finish_request(metrics, response, app.config.get('SERVER_TIMING', False))
+
+    # With LAZY_STARTUP, the first request runs the deferred startup steps
+    # before any handler or hook touches the database
+    @app.before_request
+    def finish_startup():
+        if startup.pending:
+            startup.run_deferred()
+
+    # `flask init-db` creates the schema once, for workers started with
+    # DB_CREATE_ALL=false
+    @app.cli.command('init-db')
+    def init_db():
+        create_schema()
+
+    # `flask seed-db` fills an empty database with the rows of trivia.psql,
+    # for a SQLite database used locally
+    @app.cli.command('seed-db')
+    def seed_db():
+        from seed import seed_database
+
+        create_schema()
+        print('seeded' if seed_database() else 'the database already holds questions, left as is')
+
+    def streamed_listing(query, head):
+        return Response(
+            stream_with_context(stream_questions(query, head, app.config.get('STREAM_BATCH_SIZE', 500))),
+            mimetype='application/json')
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -51,22 +165,79 @@ def create_app(test_config=None):
             if headers:
                 response.headers['Access-Control-Allow-Headers'] = headers
         return response
+
+    # Conditional GET: the read endpoints are tagged with the version of the
+    # data they show, and a request presenting the current tag in
+    # If-None-Match gets a 304 before any query runs.
+    read_versions = {
+        'retrieve_categories': lambda: 'c{}'.format(category_cache.version),
+        'get_specific_categorie': lambda: 'c{}'.format(category_cache.version),
+        'retrieve_questions': data_version.tag,
+        'retrieve_questions_based_on_category': data_version.tag,
+        'retrieve_category_stats': data_version.tag,
+    }
+
+    @app.before_request
+    def conditional_get():
+        version = read_versions.get(request.endpoint)
+        if request.method != 'GET' or version is None:
+            return None
+        g.etag = version()
+        if request.if_none_match.contains_weak(g.etag):
+            return app.response_class(status=304)
+        return None
+
+    @app.after_request
+    def tag_read_response(response):
+        etag = g.pop('etag', None)
+        if etag is not None and response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = cache_control(app.config.get('READ_CACHE_MAX_AGE', 0))
+        return response
+
+    # Response cache for the same read endpoints, consulted once the
+    # conditional GET above could not answer
+    @app.before_request
+    def serve_cached_response():
+        if response_cache is None or request.method != 'GET' or request.endpoint not in read_versions:
+            return None
+        g.cache_key = response_cache_key(request)
+        # a body computed before a write must not be stored after the write
+        # invalidated the cache
+        g.cache_generation = data_version.generation
+        body = response_cache.get(g.cache_key)
+        if body is None:
+            return None
+        g.cache_hit = True
+        response = app.response_class(body, mimetype='application/json')
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+    @app.after_request
+    def store_cached_response(response):
+        cache_key = g.pop('cache_key', None)
+        if (cache_key is not None and not g.pop('cache_hit', False)
+                and response.status_code == 200 and not response.is_streamed
+                and g.pop('cache_generation', None) == data_version.generation):
+            response_cache.set(cache_key, response.get_data(), app.config.get('RESPONSE_CACHE_TTL', 60))
+            response.headers['X-Cache'] = 'MISS'
+        return response
     """
     @TODO:
     Create an endpoint to handle GET requests
     for all available categories.
     """
     @app.route('/categories')
+    @read_only
     def retrieve_categories():
-        selection_all_categories = Category.query.order_by(Category.id).all()
-        current_categories = paginate_categories(request, selection_all_categories)
+        categories = category_cache.categories()
+        current_categories = paginate_categories(request, categories)
         if current_categories:
             try:
                 return jsonify({
                     'success': True,
-                    'categories': current_categories,
-                    'total_categories': len(selection_all_categories),
-                    'categories': {category.id: category.type for category in selection_all_categories}
+                    'total_categories': len(categories),
+                    'categories': categories
                 })
             except:
                 abort(400)
@@ -75,22 +246,34 @@ def create_app(test_config=None):
             
     # The specific search for the category of the question for fun only
     @app.route('/categories/<int:categorie_id>')
+    @read_only
     def get_specific_categorie(categorie_id):
-        selection_specific_category_by_id=Category.query.filter_by(id=categorie_id).one_or_none()
+        selection_specific_category_by_id = category_cache.get(categorie_id)
         if selection_specific_category_by_id:
             try:
-                categorySearchById = Category.query.filter_by(id=str(categorie_id)).all()
-                current_categories = paginate_categories(request,categorySearchById)
+                current_categories = paginate_categories(
+                    request, {categorie_id: selection_specific_category_by_id})
                 return jsonify({
                     'success': True,
                     'categorie': current_categories,
                     'total_category_find': len(current_categories),
-                    'category_search_by_id': selection_specific_category_by_id.type
+                    'category_search_by_id': selection_specific_category_by_id
                 })
             except:
                 abort(400)
-        else:    
+        else:
            abort(404)
+
+    # Number of questions per category and difficulty, read from the
+    # question_stats table instead of counting the questions
+    @app.route('/categories/stats')
+    @read_only
+    def retrieve_category_stats():
+        try:
+            stats = question_stats(category_cache.categories())
+        except:
+            abort(422)
+        return jsonify(dict({'success': True}, **stats))
     """
     @TODO:
     Create an endpoint to handle GET requests for questions,
@@ -104,20 +287,24 @@ def create_app(test_config=None):
     Clicking on the page numbers should update the questions.
     """
     @app.route('/questions')
+    @read_only
     def retrieve_questions():
-        selection= Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        if wants_streamed_listing(request):
+            return streamed_listing(Question.query.order_by(Question.id), {
+                'success': True,
+                'categories': category_cache.categories()
+            })
+
+        current_questions, next_cursor = paginate_questions(request, Question.query)
         if current_questions:
-            categories = Category.query.order_by(Category.id).all()
-            categoriesSelect = {}
-            for category in categories:
-                categoriesSelect[category.id] = category.type
+            categoriesSelect = category_cache.categories()
             try:
                 return jsonify({
                     'success': True,
                     'questions': current_questions,
-                    'total_questions': len(selection),
-                    'categories': categoriesSelect
+                    'total_questions': total_questions(),
+                    'categories': categoriesSelect,
+                    'next_cursor': next_cursor
                 })
             except:
                 abort(400)
@@ -139,8 +326,13 @@ def create_app(test_config=None):
                 abort(404)
 
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            if wants_minimal_response(request):
+                return jsonify({
+                    'success': True,
+                    'deleted': question_id
+                })
+
+            current_questions, next_cursor = paginate_questions(request, Question.query)
 
             # It is always a good idea to include relevant information in the response so that the correct and
             # expected behaviour of the code can be verified.
@@ -148,7 +340,7 @@ def create_app(test_config=None):
                 'success': True,
                 'deleted': question_id,
                 'questions': current_questions,
-                'total_questions': len(Question.query.all())
+                'total_questions': total_questions()
             })
 
         except:
@@ -179,19 +371,52 @@ def create_app(test_config=None):
                 question = Question(
                     question=question, answer=answer, category=category, difficulty=difficulty)
                 question.insert()
+                if wants_minimal_response(request):
+                    return jsonify({
+                        'success': True,
+                        'question_id': question.id
+                    }), 201
 
                 # send back the current questions, to update front end
-                selection = Question.query.order_by(Question.id).all()
-                currentQuestions = paginate_questions(request, selection)
+                currentQuestions, next_cursor = paginate_questions(request, Question.query)
 
                 return jsonify({
                     'success': True,
                     'question_id': question.id,
                     'questions': currentQuestions,
-                    'total_questions': len(selection)
+                    'total_questions': total_questions()
                 }), 201
         except:
             abort(422)
+
+    # Bulk import of NDJSON or CSV question packs, and the matching export
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_questions_in_bulk():
+        format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        batch_size = request.args.get('batch_size', app.config.get('BULK_BATCH_SIZE', 1000), type=int)
+        if batch_size < 1:
+            abort(400)
+
+        result = import_questions(request.stream, format, batch_size, category_cache.categories())
+
+        return jsonify({
+            'success': True,
+            'inserted': result['inserted'],
+            'total_errors': result['total_errors'],
+            'errors': result['errors']
+        }), 201 if result['inserted'] else 200
+
+    @app.route('/questions/export')
+    @read_only
+    def export_questions_in_bulk():
+        format = request.args.get('format', 'ndjson')
+        if format not in ('ndjson', 'csv'):
+            abort(400)
+        batch_size = app.config.get('BULK_BATCH_SIZE', 1000)
+
+        return Response(
+            stream_with_context(export_questions(format, batch_size)),
+            mimetype='text/csv' if format == 'csv' else 'application/x-ndjson')
     """
     @TODO:
     Create a POST endpoint to get questions based on a search term.
@@ -203,24 +428,41 @@ def create_app(test_config=None):
     Try using the word "title" to start.
     """
     @app.route('/questions/searchTerm', methods=['POST'])
+    @read_only
     def get_questions_on_a_search_term():
         body = request.get_json()
 
         searchTerm = body.get('searchTerm', None)
 
         if searchTerm:
-                questions = Question.query.order_by(Question.id).filter(
-                    Question.question.ilike('%{}%'.format(searchTerm)))
-                current_quizzes = paginate_questions(request, questions)
+                questions, total_questions, next_cursor = search_questions(
+                    request, app.extensions['search'], searchTerm, QUESTIONS_PER_PAGE)
+                current_quizzes = [Question.format_row(row) for row in questions]
 
                 return jsonify({
                     'success': True,
                     'questions': current_quizzes,
-                    'total_questions': len(questions.all()),
-                    'current_category': None
+                    'total_questions': total_questions,
+                    'current_category': None,
+                    'next_cursor': next_cursor
                 })
         else:
             abort(404)
+
+    # Search-as-you-type completion, served from memory
+    @app.route('/questions/suggest')
+    @read_only
+    def suggest_questions():
+        prefix = request.args.get('prefix', '')
+        limit = min(request.args.get('limit', SUGGESTIONS_PER_PREFIX, type=int), 50)
+        if not prefix.strip() or limit < 1:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'prefix': prefix,
+            'suggestions': app.extensions['suggest'].suggest(prefix, limit)
+        })
     """
     @TODO:
     Create a GET endpoint to get questions based on category.
@@ -230,17 +472,27 @@ def create_app(test_config=None):
     category to be shown.
     """
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @read_only
     def retrieve_questions_based_on_category(category_id):
-        selection_retrieve_question_by_category = Category.query.filter_by(id=category_id).one_or_none()
+        selection_retrieve_question_by_category = category_cache.get(category_id)
+        if selection_retrieve_question_by_category and wants_streamed_listing(request):
+            return streamed_listing(
+                Question.query.filter_by(category=category_id).order_by(Question.category, Question.id), {
+                    'success': True,
+                    'current_category': selection_retrieve_question_by_category
+                })
         if selection_retrieve_question_by_category:
             try:
-                questionsByCat = Question.query.filter_by(category=str(category_id)).all()
-                current_questions = paginate_questions(request,questionsByCat )
+                questionsByCat = Question.query.filter_by(category=category_id)
+                current_questions, next_cursor = paginate_questions(
+                    request, questionsByCat, (Question.category, Question.id),
+                    'category:{}'.format(category_id))
                 return jsonify({
                     'success': True,
                     'questions': current_questions,
-                    'total_questions': len(questionsByCat),
-                    'current_category': selection_retrieve_question_by_category.type
+                    'total_questions': total_questions(category_id),
+                    'current_category': selection_retrieve_question_by_category,
+                    'next_cursor': next_cursor
                 })
             except:
                 abort(400)
@@ -258,21 +510,28 @@ def create_app(test_config=None):
     and shown whether they were correct or not.
     """
     @app.route('/quizzes', methods=['POST'])
+    @read_only
     def questions_to_play_the_quiz():
         try:
             body = request.get_json()
 
             category = body.get('quiz_category', None)
             previous_questions = body.get('previous_questions', None)
+            count = quiz_count(body.get('count', None), app.config.get('QUIZ_MAX_COUNT', 50))
+
+            # `count` prefetches the next questions of a game in one request
+            if count is not None:
+                questions = app.extensions['quiz_pool'].pick_questions(category['id'], previous_questions, count)
+                new_questions = [question.format() for question in questions]
+
+                return jsonify({
+                    'success': True,
+                    'question': new_questions[0] if new_questions else None,
+                    'questions': new_questions
+                })
 
-            if category['id'] == 0:
-                available_questions = Question.query.filter(Question.id.notin_(previous_questions)).all()
-            else:
-                available_questions = Question.query.filter(Question.category == str(category['id'])).filter(Question.id.notin_(previous_questions)).all()
-            if len(available_questions) > 0:
-                new_question = available_questions[random.randrange(0, len(available_questions))].format()
-            else:
-                new_question = None
+            question = app.extensions['quiz_pool'].pick_question(category['id'], previous_questions)
+            new_question = question.format() if question else None
 
             return jsonify({
                 'success': True,
@@ -280,6 +539,66 @@ def create_app(test_config=None):
             })
         except:
             abort(422)
+
+    # Quiz sessions hold the questions already played on the server side
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
+        try:
+            body = request.get_json()
+            category = body.get('quiz_category', None)
+
+            started = start_session(
+                category['id'], app.config.get('QUIZ_SESSION_TTL', 3600),
+                body.get('adaptive', False), body.get('difficulty', None))
+
+            return jsonify({
+                'success': True,
+                'session_id': started['session_id'],
+                'expires_at': started['expires_at'],
+                'difficulty': started['difficulty']
+            }), 201
+        except:
+            abort(422)
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def next_quiz_session_question(session_id):
+        session = load_session(session_id)
+        if session is None:
+            abort(404)
+        try:
+            # whether the previous question was answered correctly, which
+            # moves the difficulty of an adaptive session
+            body = request.get_json(silent=True) or {}
+
+            played = next_in_session(
+                app.extensions['quiz_pool'], session, app.config.get('QUIZ_SESSION_TTL', 3600),
+                body.get('correct', None))
+
+            return jsonify({
+                'success': True,
+                'question': played['question'],
+                'rounds': played['rounds'],
+                'difficulty': played['difficulty']
+            })
+        except:
+            abort(422)
+
+    # Request metrics of this worker, in the Prometheus text format
+    @app.route('/metrics')
+    def retrieve_metrics():
+        return Response(metrics.render() + startup.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    # Connections of this worker's pools: checked out, in overflow, and the
+    # time spent waiting for them, then the health of each replica
+    @app.route('/pool')
+    def retrieve_pool_metrics():
+        replicas = app.extensions.get('replicas')
+        return jsonify({
+            'success': True,
+            'pool': pool_metrics(db.engine),
+            'replicas': replicas.metrics() if replicas is not None else []
+        })
+
     """
     @TODO:
     Create error handlers for all expected errors
@@ -335,5 +654,8 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    startup.built(started)
     return app
 
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
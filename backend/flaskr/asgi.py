@@ -0,0 +1,263 @@
+import asyncio
+import json
+import re
+from datetime import datetime
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import delete, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+
+from models import Question, QuizSession
+from pooling import engine_options, statement_timeout
+from . import create_app
+from .quiz import (SeenBitmap, category_key, quiz_count, ids_query, difficulty_order, new_session, is_live,
+                   next_difficulty, advance_session, SESSION_ATTEMPTS)
+from .serialization import dumps
+from .startup import ensure_started
+
+"""
+ASGI serving mode
+    create_asgi_app(test_config) wraps the app of create_app() for an ASGI
+    server, for instance:
+
+        uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+
+    The quiz rounds, the endpoints players hit in a loop, are served by the
+    async handlers below through an async SQLAlchemy session: a request
+    waiting on the database holds no thread, so one process can keep
+    thousands of players going. They share the QuizPool of the app and
+    answer exactly like their Flask counterparts. Every other request is
+    handed to the Flask app, run in a thread pool.
+
+    The async engine uses asyncpg for Postgres and aiosqlite for SQLite
+    (pip install asgiref asyncpg aiosqlite), on ASYNC_DATABASE_URI or the
+    URI of the app with its driver swapped, and always on the primary.
+"""
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+def async_database_uri(uri):
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+# the pool settings of the Flask app: the async engine keeps its own pool
+# class, and asyncpg takes the statement timeout as a server setting
+def async_engine_options(uri, config):
+    options = engine_options(uri, config)
+    options.pop('poolclass', None)
+    timeout = statement_timeout(uri, config)
+    if timeout is not None:
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(timeout)}}
+    return options
+
+class HTTPError(Exception):
+
+    MESSAGES = {404: 'resource not found', 422: 'unprocessable'}
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+async def ids_for(pool, session, category, difficulty=None):
+    ids = pool.cached_ids(category, difficulty)
+    if ids is None:
+        ids = pool.load(
+            category, await session.scalars(ids_query(select(Question.id), category, difficulty)), difficulty)
+    return ids
+
+"""
+pick(pool, session, category, seen, difficulty)
+pick_many(pool, session, category, seen, count)
+    QuizPool.pick() and QuizPool.pick_many() over an async session
+"""
+async def pick(pool, session, category, seen, difficulty=None):
+    while True:
+        question_id = pool.draw(await ids_for(pool, session, category, difficulty), seen)
+        if question_id is None:
+            return None
+        question = await session.get(Question, question_id)
+        if pool.accepts(question_id, question, category, difficulty):
+            return question
+
+async def pick_many(pool, session, category, seen, count):
+    questions = []
+    seen = set(seen)
+    while len(questions) < count:
+        question_ids = pool.sample(await ids_for(pool, session, category), seen, count - len(questions))
+        if not question_ids:
+            break
+        seen.update(question_ids)
+        found = {
+            question.id: question
+            for question in await session.scalars(select(Question).where(Question.id.in_(question_ids)))
+        }
+        questions.extend(
+            found[question_id] for question_id in question_ids
+            if pool.accepts(question_id, found.get(question_id), category))
+    return questions
+
+async def pick_near(pool, session, category, seen, target):
+    for difficulty in difficulty_order(target):
+        question = await pick(pool, session, category, seen, difficulty)
+        if question is not None:
+            return question
+    return None
+
+class TriviaASGI:
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        uri = app.config.get('ASYNC_DATABASE_URI') or async_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.engine = create_async_engine(uri, **async_engine_options(uri, app.config))
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.routes = [
+            (re.compile(r'/quizzes'), self.play_quiz),
+            (re.compile(r'/quizzes/sessions'), self.start_quiz_session),
+            (re.compile(r'/quizzes/sessions/(?P<session_id>[^/]+)/next'), self.next_quiz_session_question),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            for pattern, handler in self.routes:
+                match = pattern.fullmatch(scope['path'])
+                if match is not None:
+                    await self.respond(send, handler, await self.read_json(receive), **match.groupdict())
+                    return
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_json(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    async def respond(self, send, handler, body, **params):
+        if self.app.extensions['startup'].pending:
+            await asyncio.to_thread(ensure_started, self.app)
+        try:
+            async with self.sessions() as session:
+                status, payload = await handler(session, body, **params)
+        except HTTPError as error:
+            status, payload = error.status, {
+                'success': False, 'error': error.status, 'message': HTTPError.MESSAGES[error.status]}
+        with self.app.app_context():
+            content = dumps(payload)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(content)).encode('ascii')),
+                (b'access-control-allow-origin', b'*'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def play_quiz(self, session, body):
+        try:
+            category = body.get('quiz_category', None)
+            previous_questions = body.get('previous_questions', None)
+            count = quiz_count(body.get('count', None), self.app.config.get('QUIZ_MAX_COUNT', 50))
+
+            if count is not None:
+                questions = await pick_many(
+                    self.app.extensions['quiz_pool'], session, category_key(category['id']),
+                    set(previous_questions), count)
+            else:
+                question = await pick(
+                    self.app.extensions['quiz_pool'], session, category_key(category['id']), set(previous_questions))
+        except Exception:
+            raise HTTPError(422)
+        if count is not None:
+            new_questions = [question.format() for question in questions]
+            return 200, {
+                'success': True,
+                'question': new_questions[0] if new_questions else None,
+                'questions': new_questions
+            }
+        return 200, {
+            'success': True,
+            'question': question.format() if question else None
+        }
+
+    async def start_quiz_session(self, session, body):
+        try:
+            category = body.get('quiz_category', None)
+
+            await session.execute(delete(QuizSession).where(QuizSession.expires_at < datetime.utcnow()))
+            quiz_session = new_session(
+                category['id'], self.app.config.get('QUIZ_SESSION_TTL', 3600),
+                body.get('adaptive', False), body.get('difficulty', None))
+            session.add(quiz_session)
+            await session.commit()
+        except Exception:
+            raise HTTPError(422)
+        return 201, {
+            'success': True,
+            'session_id': quiz_session.id,
+            'expires_at': quiz_session.expires_at.isoformat(),
+            'difficulty': quiz_session.difficulty
+        }
+
+    async def next_quiz_session_question(self, session, body, session_id):
+        quiz_session = await session.get(QuizSession, session_id)
+        if not is_live(quiz_session):
+            raise HTTPError(404)
+        try:
+            for attempt in range(1, SESSION_ATTEMPTS + 1):
+                try:
+                    question = await self.play_round(session, quiz_session, (body or {}).get('correct', None))
+                    break
+                except StaleDataError:
+                    # another request played a round meanwhile: play on the fresh session
+                    await session.rollback()
+                    if attempt == SESSION_ATTEMPTS:
+                        raise
+                    await session.refresh(quiz_session)
+        except Exception:
+            raise HTTPError(422)
+        return 200, {
+            'success': True,
+            'question': question.format() if question else None,
+            'rounds': quiz_session.rounds,
+            'difficulty': quiz_session.difficulty
+        }
+
+    async def play_round(self, session, quiz_session, correct):
+        seen = SeenBitmap(quiz_session.seen)
+        difficulty = next_difficulty(quiz_session, correct)
+        pool = self.app.extensions['quiz_pool']
+        if difficulty is None:
+            question = await pick(pool, session, quiz_session.category, seen)
+        else:
+            question = await pick_near(pool, session, quiz_session.category, seen, difficulty)
+        quiz_session.difficulty = difficulty
+        advance_session(quiz_session, seen, question, self.app.config.get('QUIZ_SESSION_TTL', 3600))
+        await session.commit()
+        return question
+
+def create_asgi_app(test_config=None):
+    return TriviaASGI(create_app(test_config))
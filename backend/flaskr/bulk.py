@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+import re
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Question
+
+"""
+Bulk import and export of questions
+
+    import_questions(stream, format, batch_size, categories)
+        reads NDJSON (one question object per line) or CSV (with a
+        question,answer,category,difficulty header) from the request
+        stream line by line and inserts the valid rows `batch_size` at a
+        time with a single executemany per batch. Invalid rows are
+        reported with their line number instead of failing the import; if
+        the database rejects a batch it is replayed row by row to find the
+        offending lines.
+
+    export_questions(format, batch_size)
+        yields the questions ordered by id as NDJSON or CSV chunks, reading
+        them `batch_size` rows at a time through a server-side cursor so
+        memory stays flat whatever the size of the table.
+"""
+
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+# errors beyond this number are only counted
+MAX_REPORTED_ERRORS = 100
+
+# the bytes that are not UTF-8 are decoded to lone surrogates, which valid
+# UTF-8 never yields, so the rows holding them are reported by line
+UNDECODABLE = re.compile('[\udc80-\udcff]')
+NOT_UTF8 = object()
+
+def _records(stream, format):
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            if any(UNDECODABLE.search(value) for value in record.values() if isinstance(value, str)):
+                record = NOT_UTF8
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        if UNDECODABLE.search(line):
+            yield line_number, NOT_UTF8
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None
+            continue
+        yield line_number, record
+
+def _validate(record, categories):
+    if record is NOT_UTF8:
+        return None, 'not valid UTF-8'
+    if not isinstance(record, dict):
+        return None, 'not a question object'
+    question = record.get('question')
+    answer = record.get('answer')
+    if not isinstance(question, str) or not question.strip():
+        return None, 'missing question'
+    if not isinstance(answer, str) or not answer.strip():
+        return None, 'missing answer'
+    try:
+        category = int(record.get('category'))
+        difficulty = int(record.get('difficulty'))
+    except (TypeError, ValueError):
+        return None, 'category and difficulty must be integers'
+    if category not in categories:
+        return None, 'unknown category {}'.format(category)
+    return {
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty
+    }, None
+
+def import_questions(stream, format, batch_size, categories):
+    result = {'inserted': 0, 'total_errors': 0, 'errors': []}
+
+    def report(line_number, error):
+        result['total_errors'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append({'line': line_number, 'error': error})
+
+    def flush(batch):
+        try:
+            Question.bulk_insert([row for line_number, row in batch])
+            result['inserted'] += len(batch)
+        except SQLAlchemyError:
+            db.session.rollback()
+            for line_number, row in batch:
+                try:
+                    Question.bulk_insert([row])
+                    result['inserted'] += 1
+                except SQLAlchemyError as error:
+                    db.session.rollback()
+                    report(line_number, str(getattr(error, 'orig', None) or error).splitlines()[0])
+
+    batch = []
+    for line_number, record in _records(stream, format):
+        row, error = _validate(record, categories)
+        if error is not None:
+            report(line_number, error)
+            continue
+        batch.append((line_number, row))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    return result
+
+def export_questions(format, batch_size):
+    columns = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+    rows = db.session.query(*columns).order_by(Question.id)\
+        .execution_options(stream_results=True).yield_per(batch_size)
+
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('id',) + FIELDS)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(('id',) + FIELDS, row))))
+        if len(chunk) >= batch_size:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+import zlib
+
+from flask import current_app, has_app_context
+
+from models import db, on_change, is_change_of, Category
+
+"""
+CategoryCache
+    the {id: type} map of the categories, loaded once and shared by every
+    endpoint that lists or names categories. It is dropped whenever a
+    category is inserted, updated or deleted through the models, and
+    reloaded after `ttl` seconds to pick up the writes of other workers.
+
+    `version` is a checksum of the cached map, so it only changes with the
+    categories themselves and is the same in every worker, which makes it
+    safe to use in an ETag.
+
+    Every invalidate() bumps a generation, and a map loaded while one ran
+    is served to its request but not kept, so a write landing during a
+    load is not hidden for `ttl` seconds.
+"""
+class CategoryCache:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._categories = None
+        self._version = None
+        self._loaded_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._categories is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._categories, self._version
+            generation = self._generation
+
+        categories = {
+            category_id: type
+            for category_id, type in db.session.query(Category.id, Category.type).order_by(Category.id)
+        }
+        version = zlib.crc32(json.dumps(sorted(categories.items())).encode('utf-8'))
+
+        with self._lock:
+            if generation == self._generation:
+                self._categories = categories
+                self._version = version
+                self._loaded_at = time.monotonic()
+        return categories, version
+
+    def categories(self):
+        return self._ensure_loaded()[0]
+
+    def get(self, category_id):
+        return self.categories().get(category_id)
+
+    @property
+    def version(self):
+        return self._ensure_loaded()[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._categories = None
+            self._generation += 1
+
+
+@on_change
+def _follow_category_writes(action, instance):
+    if not is_change_of(instance, Category) or not has_app_context():
+        return
+    cache = current_app.extensions.get('categories')
+    if cache is not None:
+        cache.invalidate()
@@ -0,0 +1,51 @@
+import secrets
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from models import on_change, is_change_of, Question, Category
+
+"""
+DataVersion
+    counter bumped by every question or category write of this process,
+    used to build the ETags of the question listings so a matching
+    If-None-Match is answered with a 304 before any query runs.
+
+    The tag also carries a random id of the process, so a tag issued by
+    one worker never validates on another, and the current `window` of
+    seconds, which bounds how long a worker can keep confirming a tag
+    after another worker changed the data.
+"""
+class DataVersion:
+
+    def __init__(self, window=60):
+        self.window = window
+        self.epoch = secrets.token_hex(4)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self._counter += 1
+
+    @property
+    def generation(self):
+        return self._counter
+
+    def tag(self):
+        return 'q{}.{}.{}'.format(self.epoch, self._counter, int(time.time() // self.window))
+
+def cache_control(max_age):
+    if max_age > 0:
+        return 'public, max-age={}'.format(max_age)
+    return 'no-cache'
+
+
+@on_change
+def _follow_writes(action, instance):
+    if not is_change_of(instance, Question, Category) or not has_app_context():
+        return
+    data_version = current_app.extensions.get('data_version')
+    if data_version is not None:
+        data_version.bump()
@@ -0,0 +1,154 @@
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+Request metrics
+    every request handled by the app is measured: its latency, the SQL
+    statements it ran and the time they took (counted through SQLAlchemy
+    cursor events, on the primary as on the replicas), the rows they
+    returned, and the size of the response. RequestMetrics keeps them as
+    histograms per endpoint and renders them in the Prometheus text format
+    on GET /metrics; with SERVER_TIMING on, each response also carries them
+    in a Server-Timing header.
+
+    The figures are those of the worker answering, as Prometheus expects
+    when it scrapes every worker. Rows are the ones reported by the driver,
+    which Postgres does and SQLite does not, and the SQL run while a
+    streamed response is being sent is not counted.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+def _labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return ','.join(pairs)
+
+class Counter:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values):
+        self.series[values] = self.series.get(values, 0) + 1
+
+    def render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        lines.append('# TYPE {} counter'.format(self.name))
+        for values, count in sorted(self.series.items()):
+            lines.append('{}{{{}}} {}'.format(self.name, _labels(self.labels, values), count))
+
+class Histogram:
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self.series = {}
+
+    def observe(self, values, value):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * len(self.buckets) + [0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        lines.append('# TYPE {} histogram'.format(self.name))
+        for values, series in sorted(self.series.items()):
+            labels = _labels(self.labels, values)
+            for bound, count in zip(self.buckets, series):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, labels, series[-1]))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels, round(series[-2], 6)))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels, series[-1]))
+
+class RequestMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        route = ('endpoint', 'method')
+        self.requests = Counter(
+            'trivia_requests_total', 'Requests answered.', route + ('status',))
+        self.latency = Histogram(
+            'trivia_request_duration_seconds', 'Time to answer a request.', route, LATENCY_BUCKETS)
+        self.queries = Histogram(
+            'trivia_request_sql_queries', 'SQL statements run by a request.', route, QUERY_BUCKETS)
+        self.sql_time = Histogram(
+            'trivia_request_sql_duration_seconds', 'Time spent in SQL by a request.', route, LATENCY_BUCKETS)
+        self.rows = Histogram(
+            'trivia_request_sql_rows', 'Rows returned to a request by the database.', route, ROW_BUCKETS)
+        self.size = Histogram(
+            'trivia_response_size_bytes', 'Size of the response body.', route, SIZE_BUCKETS)
+
+    def observe(self, endpoint, method, status, seconds, queries, sql_seconds, rows, size):
+        route = (endpoint, method)
+        with self._lock:
+            self.requests.inc(route + (str(status),))
+            self.latency.observe(route, seconds)
+            self.queries.observe(route, queries)
+            self.sql_time.observe(route, sql_seconds)
+            self.rows.observe(route, rows)
+            if size is not None:
+                self.size.observe(route, size)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.latency, self.queries, self.sql_time, self.rows, self.size):
+                metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.sql_rows = 0
+
+def finish_request(metrics, response, server_timing=False):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    size = None if response.is_streamed else response.calculate_content_length()
+
+    metrics.observe(
+        request.endpoint or 'unmatched', request.method, response.status_code,
+        seconds, g.sql_queries, g.sql_seconds, g.sql_rows, size)
+    if server_timing:
+        response.headers['Server-Timing'] = 'db;desc="{} queries, {} rows";dur={:.3f}, total;dur={:.3f}'.format(
+            g.sql_queries, g.sql_rows, g.sql_seconds * 1000, seconds * 1000)
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _count_query(connection, cursor, statement, parameters, context, executemany):
+    if context is None or not has_request_context() or 'request_started' not in g:
+        return
+    g.sql_queries += 1
+    g.sql_seconds += time.perf_counter() - context.query_started
+    if cursor.description is not None and cursor.rowcount > 0:
+        g.sql_rows += cursor.rowcount
@@ -0,0 +1,79 @@
+from flask import abort, current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import func, tuple_
+
+"""
+paginate(request, query, keys, per_page, scope)
+    pushes the page selection into the query itself so only one page of
+    rows is loaded, and returns the rows plus an opaque `next_cursor`.
+
+    A page can be chosen three ways:
+      ?cursor=   signed token from a previous response, seeks past the
+                 last row with WHERE (keys) > (last values)
+      ?after_id= seeks past the given id (single key listings only)
+      ?page=     classic LIMIT/OFFSET, cost grows with the page number
+
+    Seeking keeps deep pages as cheap as the first one and a cursor never
+    skips or repeats rows when questions are added or deleted mid-browse.
+"""
+def paginate(request, query, keys, per_page, scope):
+    query = query.order_by(*keys)
+
+    cursor = request_cursor(request)
+    after_id = request.args.get('after_id', None, type=int)
+    if cursor is not None:
+        query = query.filter(tuple_(*keys) > tuple_(*load_cursor(cursor, scope, len(keys))))
+    elif after_id is not None:
+        query = query.filter(keys[-1] > after_id)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], None
+        query = query.offset((page - 1) * per_page)
+
+    # one extra row tells us whether there is a next page without a COUNT
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = dump_cursor(rows[-1], keys, scope)
+
+    return rows, next_cursor
+
+def count_rows(query, key):
+    return query.order_by(None).with_entities(func.count(key)).scalar()
+
+# only the POST listings (/questions/searchTerm) read the cursor from the
+# body: a GET is cached by its path and query string alone
+def request_cursor(request):
+    cursor = request.args.get('cursor', None)
+    if cursor is None and request.method == 'POST' and request.is_json:
+        cursor = (request.get_json(silent=True) or {}).get('cursor', None)
+    return cursor
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='trivia-cursor')
+
+def dump_cursor(row, keys, scope):
+    return encode_cursor([getattr(row, key.key) for key in keys], scope)
+
+def encode_cursor(values, scope):
+    return _serializer().dumps({'scope': scope, 'keys': list(values)})
+
+# A cursor is only valid for the listing that issued it: a forged token,
+# one from another category or search term, or one not holding `size`
+# key values, is a bad request.
+def load_cursor(cursor, scope, size):
+    try:
+        data = _serializer().loads(cursor)
+    except BadSignature:
+        abort(400)
+    if not isinstance(data, dict) or data.get('scope') != scope:
+        abort(400)
+    keys = data.get('keys')
+    if not isinstance(keys, list) or len(keys) != size or not all(_is_key_value(key) for key in keys):
+        abort(400)
+    return keys
+
+def _is_key_value(value):
+    return isinstance(value, (int, float, str)) and not isinstance(value, bool)
@@ -0,0 +1,377 @@
+import random
+import secrets
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy.orm.exc import StaleDataError
+
+from models import db, on_change, is_change_of, Question, QuizSession
+
+"""
+PoolIds
+    the ids of one key of the pool: a sorted array that only grows, and
+    the set of the ids discarded since it was loaded. Discarding an id is a
+    set insert instead of an array scan, membership a binary search, and a
+    draw reads the array under the lock, so the draws of other threads never
+    see it shrink. The discarded ids go away when the key is reloaded.
+"""
+class PoolIds:
+
+    def __init__(self, question_ids):
+        self.ids = array('q', sorted(question_ids))
+        self.removed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids) - len(self.removed)
+
+    def _index(self, question_id):
+        index = bisect_left(self.ids, question_id)
+        return index if index < len(self.ids) and self.ids[index] == question_id else None
+
+    def __contains__(self, question_id):
+        with self._lock:
+            return self._index(question_id) is not None and question_id not in self.removed
+
+    def add(self, question_id):
+        with self._lock:
+            if question_id in self.removed:
+                self.removed.discard(question_id)
+            elif self._index(question_id) is None:
+                self.ids.insert(bisect_left(self.ids, question_id), question_id)
+
+    def discard(self, question_id):
+        with self._lock:
+            if self._index(question_id) is not None:
+                self.removed.add(question_id)
+
+    # a random id, None when it was discarded
+    def random_id(self):
+        with self._lock:
+            if not self.ids:
+                return None
+            question_id = self.ids[random.randrange(len(self.ids))]
+        return None if question_id in self.removed else question_id
+
+    def live(self):
+        with self._lock:
+            return [question_id for question_id in self.ids if question_id not in self.removed]
+
+"""
+QuizPool
+    keeps the question ids of every category (and of the whole bank, under
+    the key None), whole and split by difficulty, in compact arrays, so
+    /quizzes can draw a random unseen question without loading the
+    candidate rows or sending a NOT IN list to the database. A round costs
+    a few random draws plus one primary key lookup, whatever the size of
+    the bank.
+
+    The arrays follow the writes of this process through the model change
+    listeners. Writes made by other workers are picked up when an array is
+    reloaded after `ttl` seconds, and a drawn id whose row has disappeared
+    or moved to another category is dropped and drawn again.
+
+    The arrays are shared by the threads of the worker: see PoolIds.
+
+    pick_near() serves the adaptive sessions: it walks the difficulty
+    arrays nearest to the target first, so a round still costs a few draws
+    per difficulty at most. pick_many() draws the next `count` questions of
+    a game at once and fetches them in a single query.
+"""
+class QuizPool:
+
+    # draws before giving up on rejection sampling, which only happens
+    # once most of the pool has been seen
+    ATTEMPTS = 8
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._ids = {}
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+
+    # cached_ids(), load(), draw() and accepts() are the steps of pick(),
+    # shared with the async quiz handlers of flaskr.asgi
+    def cached_ids(self, category, difficulty=None):
+        key = (category, difficulty)
+        with self._lock:
+            loaded_at = self._loaded_at.get(key)
+            if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+                return self._ids[key]
+        return None
+
+    def load(self, category, question_ids, difficulty=None):
+        key = (category, difficulty)
+        ids = PoolIds(question_ids)
+        with self._lock:
+            self._ids[key] = ids
+            self._loaded_at[key] = time.monotonic()
+        return ids
+
+    def _ids_for(self, category, difficulty=None):
+        ids = self.cached_ids(category, difficulty)
+        if ids is None:
+            query = ids_query(db.session.query(Question.id), category, difficulty)
+            ids = self.load(category, (row[0] for row in query), difficulty)
+        return ids
+
+    def add(self, question):
+        with self._lock:
+            for category in (None, question.category):
+                for difficulty in (None, question.difficulty):
+                    ids = self._ids.get((category, difficulty))
+                    if ids is not None:
+                        ids.add(question.id)
+
+    def reset(self):
+        with self._lock:
+            self._ids = {}
+            self._loaded_at = {}
+
+    def discard(self, question_id):
+        with self._lock:
+            for ids in self._ids.values():
+                ids.discard(question_id)
+
+    def draw(self, ids, seen):
+        if not ids:
+            return None
+        for _ in range(self.ATTEMPTS):
+            question_id = ids.random_id()
+            if question_id is not None and question_id not in seen:
+                return question_id
+        candidates = [question_id for question_id in ids.live() if question_id not in seen]
+        return random.choice(candidates) if candidates else None
+
+    def sample(self, ids, seen, count):
+        drawn = []
+        for _ in range(self.ATTEMPTS * count):
+            if len(drawn) == count or not ids:
+                return drawn
+            question_id = ids.random_id()
+            if question_id is not None and question_id not in seen and question_id not in drawn:
+                drawn.append(question_id)
+        candidates = [question_id for question_id in ids.live() if question_id not in seen and question_id not in drawn]
+        return drawn + random.sample(candidates, min(count - len(drawn), len(candidates)))
+
+    def accepts(self, question_id, question, category, difficulty=None):
+        if (question is None or (category is not None and question.category != category)
+                or (difficulty is not None and question.difficulty != difficulty)):
+            self.discard(question_id)
+            return False
+        return True
+
+    def pick(self, category, seen, difficulty=None):
+        while True:
+            question_id = self.draw(self._ids_for(category, difficulty), seen)
+            if question_id is None:
+                return None
+            question = Question.query.get(question_id)
+            if self.accepts(question_id, question, category, difficulty):
+                return question
+
+    def draw_near(self, category, seen, target):
+        for difficulty in difficulty_order(target):
+            question_id = self.draw(self._ids_for(category, difficulty), seen)
+            if question_id is not None:
+                return question_id, difficulty
+        return None, None
+
+    def pick_near(self, category, seen, target):
+        while True:
+            question_id, difficulty = self.draw_near(category, seen, target)
+            if question_id is None:
+                return None
+            question = Question.query.get(question_id)
+            if self.accepts(question_id, question, category, difficulty):
+                return question
+
+    def pick_many(self, category, seen, count):
+        questions = []
+        seen = set(seen)
+        while len(questions) < count:
+            question_ids = self.sample(self._ids_for(category), seen, count - len(questions))
+            if not question_ids:
+                break
+            seen.update(question_ids)
+            found = {question.id: question for question in Question.query.filter(Question.id.in_(question_ids))}
+            questions.extend(
+                found[question_id] for question_id in question_ids
+                if self.accepts(question_id, found.get(question_id), category))
+        return questions
+
+    def pick_question(self, category_id, previous_questions):
+        return self.pick(category_key(category_id), set(previous_questions))
+
+    def pick_questions(self, category_id, previous_questions, count):
+        return self.pick_many(category_key(category_id), set(previous_questions), count)
+
+
+# quiz_category id 0 stands for "All"
+def category_key(category_id):
+    return int(category_id or 0) or None
+
+def ids_query(query, category, difficulty=None):
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    return query
+
+# questions a /quizzes request can ask for at once, `count` defaulting to a
+# single question sent back as `question` only
+def quiz_count(count, limit):
+    if count is None:
+        return None
+    if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= limit:
+        raise ValueError('count must be between 1 and {}'.format(limit))
+    return count
+
+# difficulties of the questions, from the easiest, and the target an
+# adaptive session starts from unless told otherwise
+DIFFICULTIES = range(1, 6)
+START_DIFFICULTY = 3
+
+def difficulty_key(difficulty):
+    if difficulty is None:
+        return START_DIFFICULTY
+    if isinstance(difficulty, bool) or int(difficulty) != difficulty or difficulty not in DIFFICULTIES:
+        raise ValueError('difficulty must be one of {}'.format(list(DIFFICULTIES)))
+    return int(difficulty)
+
+# the difficulties to try for a target, nearest first, easier on a tie
+def difficulty_order(target):
+    return sorted(DIFFICULTIES, key=lambda difficulty: (abs(difficulty - target), difficulty))
+
+"""
+SeenBitmap
+    set of question ids stored one bit per id. It is zlib compressed when
+    saved, so a session of a few rounds costs a few dozen bytes even when
+    the ids run into the millions.
+"""
+class SeenBitmap:
+
+    def __init__(self, data=None):
+        self._bits = bytearray(zlib.decompress(data)) if data else bytearray()
+
+    def __contains__(self, question_id):
+        byte = question_id >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (question_id & 7)))
+
+    def add(self, question_id):
+        byte = question_id >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        self._bits[byte] |= 1 << (question_id & 7)
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self._bits))
+
+"""
+Quiz sessions
+    keep the seen set of a game server-side, so a round only sends the
+    session id instead of the growing previous_questions list. Every round
+    pushes the expiry `ttl` seconds further; expired sessions are purged
+    when a new one starts.
+
+    An adaptive session also keeps a target difficulty. The player reports
+    whether the last question was answered correctly, which moves the
+    target one step up or down, and the next question is the unseen one
+    nearest to the target.
+"""
+def new_session(category_id, ttl, adaptive=False, difficulty=None):
+    return QuizSession(
+        id=secrets.token_hex(16), category=category_key(category_id),
+        seen=SeenBitmap().to_bytes(), expires_at=datetime.utcnow() + timedelta(seconds=ttl),
+        difficulty=difficulty_key(difficulty) if adaptive else None)
+
+def is_live(session):
+    return session is not None and session.expires_at >= datetime.utcnow()
+
+# the target of the next round, set on the session once the question is
+# picked so the pick does not flush the session first
+def next_difficulty(session, correct):
+    if correct is not None and not isinstance(correct, bool):
+        raise ValueError('correct must be a boolean')
+    if session.difficulty is None or correct is None:
+        return session.difficulty
+    step = 1 if correct else -1
+    return min(max(session.difficulty + step, DIFFICULTIES[0]), DIFFICULTIES[-1])
+
+def advance_session(session, seen, question, ttl):
+    if question is not None:
+        seen.add(question.id)
+        session.seen = seen.to_bytes()
+        session.rounds += 1
+    session.expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+
+# start_session() and next_in_session() return what the handlers send back,
+# read before the commit expires the session and question loaded
+def start_session(category_id, ttl, adaptive=False, difficulty=None):
+    QuizSession.query.filter(QuizSession.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+    session = new_session(category_id, ttl, adaptive, difficulty)
+    started = {
+        'session_id': session.id,
+        'expires_at': session.expires_at.isoformat(),
+        'difficulty': session.difficulty
+    }
+    session.insert()
+    return started
+
+def load_session(session_id):
+    session = QuizSession.query.get(session_id)
+    return session if is_live(session) else None
+
+# Two rounds of the same session played at once would serve the same
+# question and overwrite each other's seen set: the update of a round only
+# matches the session if its rounds are still those read (see the mapper
+# of QuizSession), and the round is played again on the fresh session
+SESSION_ATTEMPTS = 3
+
+def next_in_session(pool, session, ttl, correct=None):
+    for attempt in range(1, SESSION_ATTEMPTS + 1):
+        try:
+            return play_round(pool, session, ttl, correct)
+        except StaleDataError:
+            # expires the session, reloaded by the next attempt
+            db.session.rollback()
+            if attempt == SESSION_ATTEMPTS:
+                raise
+
+def play_round(pool, session, ttl, correct=None):
+    seen = SeenBitmap(session.seen)
+    difficulty = next_difficulty(session, correct)
+    if difficulty is None:
+        question = pool.pick(session.category, seen)
+    else:
+        question = pool.pick_near(session.category, seen, difficulty)
+    session.difficulty = difficulty
+    advance_session(session, seen, question, ttl)
+    played = {
+        'question': question.format() if question else None,
+        'rounds': session.rounds,
+        'difficulty': session.difficulty
+    }
+    session.update()
+    return played
+
+
+@on_change
+def _follow_question_writes(action, instance):
+    if not is_change_of(instance, Question) or not has_app_context():
+        return
+    pool = current_app.extensions.get('quiz_pool')
+    if pool is None:
+        return
+    if action == 'bulk_insert':
+        pool.reset()
+        return
+    if action != 'insert':
+        pool.discard(instance.id)
+    if action != 'delete':
+        pool.add(instance)
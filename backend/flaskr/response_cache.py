@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+from models import on_change, is_change_of, Question, Category
+
+"""
+Response cache
+    keeps the JSON bodies of the hot read endpoints, keyed by route and
+    normalized query arguments. Any backend providing
+
+        get(key)              -> bytes or None
+        set(key, value, ttl)
+        invalidate()          drops every entry
+
+    can be passed as RESPONSE_CACHE in the app config; the strings 'lru'
+    (default) and 'redis' select the backends below and None turns the
+    cache off. Question and category writes invalidate the whole cache,
+    and `ttl` bounds how long a worker serves entries after a write made
+    by another worker (the redis backend is shared, so it has no such lag).
+"""
+
+def response_cache_key(request):
+    args = '&'.join(
+        '{}={}'.format(name, value)
+        for name in sorted(request.args)
+        for value in request.args.getlist(name)
+    )
+    return '{}?{}'.format(request.path, args)
+
+"""
+LRUBackend
+    bounded in-process default, evicting the least recently used entry
+    once `size` responses are held.
+"""
+class LRUBackend:
+
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+"""
+RedisBackend
+    shared backend over any client with get, set(ex=) and incr, such as
+    redis-py or a local stand-in. Invalidation bumps a generation number
+    that prefixes every key, so it is a single command however many
+    entries are cached; stale generations expire on their own.
+"""
+class RedisBackend:
+
+    def __init__(self, client, prefix='trivia:response:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        generation = self.client.get(self.prefix + 'generation') or b'0'
+        if isinstance(generation, bytes):
+            generation = generation.decode('ascii')
+        return '{}{}:{}'.format(self.prefix, generation, key)
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl):
+        self.client.set(self._key(key), value, ex=ttl)
+
+    def invalidate(self):
+        self.client.incr(self.prefix + 'generation')
+
+
+def create_response_cache(config):
+    backend = config.get('RESPONSE_CACHE', 'lru')
+    if backend is None:
+        return None
+    if backend == 'lru':
+        return LRUBackend(config.get('RESPONSE_CACHE_SIZE', 256))
+    if backend == 'redis':
+        import redis
+        return RedisBackend(redis.Redis.from_url(config['RESPONSE_CACHE_URL']))
+    return backend
+
+
+@on_change
+def _follow_writes(action, instance):
+    if not is_change_of(instance, Question, Category) or not has_app_context():
+        return
+    response_cache = current_app.extensions.get('response_cache')
+    if response_cache is not None:
+        response_cache.invalidate()
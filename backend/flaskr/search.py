@@ -0,0 +1,248 @@
+import logging
+import threading
+import time
+from bisect import bisect_right
+
+from flask import current_app, has_app_context
+from sqlalchemy import bindparam, case, func, select, text, tuple_
+
+from models import db, on_change, is_change_of, Question
+from .pagination import encode_cursor, load_cursor, request_cursor
+
+"""
+Question search
+    matches the search term as a case-insensitive substring of the question
+    or the answer and ranks the hits by
+        (0 if the question matches else 1, 1-based match position, id)
+    so questions that start with the term come first. Both engines below
+    return the same ranking, which is also the key the cursors seek on.
+"""
+
+logger = logging.getLogger(__name__)
+
+def search_questions(request, engine, term, per_page):
+    scope = 'search:{}'.format(term)
+    cursor = request_cursor(request)
+    # cursors seek on the (field, position, id) rank
+    after = load_cursor(cursor, scope, 3) if cursor is not None else None
+    offset = 0
+    if after is None:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], 0, None
+        offset = (page - 1) * per_page
+
+    rows, total = engine.search(term, after, offset, per_page + 1)
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][1], scope)
+
+    return [row for row, rank in rows], total, next_cursor
+
+def _like_pattern(term):
+    escaped = term.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return '%{}%'.format(escaped)
+
+"""
+TrigramSearch
+    Postgres engine: the pg_trgm GIN indexes built by the migration
+    0006_questions_trigram_indexes let ILIKE '%term%' use an index scan, and
+    count(*) OVER () returns the number of hits with the ranked page, from a
+    single query. Without the indexes the same query scans the table.
+"""
+class TrigramSearch:
+
+    def __init__(self):
+        self.indexed = None
+
+    def prepare(self):
+        from migrations import TRIGRAM_INDEXES
+
+        found = db.session.execute(text(
+            'SELECT count(*) FROM pg_indexes WHERE tablename = :table AND indexname IN :names'
+        ).bindparams(bindparam('names', expanding=True)),
+            {'table': 'questions', 'names': list(TRIGRAM_INDEXES)}).scalar()
+        self.indexed = found == len(TRIGRAM_INDEXES)
+        if not self.indexed:
+            logger.warning('trigram indexes missing, the search will scan the questions')
+
+    def search(self, term, after, offset, limit):
+        pattern = _like_pattern(term)
+        lowered = term.lower()
+        in_question = Question.question.ilike(pattern, escape='!')
+        field = case((in_question, 0), else_=1)
+        position = case(
+            (in_question, func.strpos(func.lower(Question.question), lowered)),
+            else_=func.strpos(func.lower(Question.answer), lowered))
+
+        ranked = select(
+            Question.id.label('id'),
+            field.label('field'),
+            position.label('position'),
+            func.count().over().label('total')
+        ).where(in_question | Question.answer.ilike(pattern, escape='!')).subquery()
+
+        query = db.session.query(*Question.columns(), ranked.c.field, ranked.c.position, ranked.c.total)\
+            .join(ranked, Question.id == ranked.c.id)\
+            .order_by(ranked.c.field, ranked.c.position, ranked.c.id)
+        if after is not None:
+            query = query.filter(tuple_(ranked.c.field, ranked.c.position, ranked.c.id) > tuple_(*after))
+        rows = query.offset(offset).limit(limit).all()
+
+        if rows:
+            total = rows[0].total
+        elif after is None and offset == 0:
+            total = 0
+        else:
+            total = db.session.query(func.count(ranked.c.id)).scalar()
+        width = len(Question.FIELDS)
+        return [(row[:width], (row.field, row.position, row.id)) for row in rows], total
+
+"""
+InvertedIndexSearch
+    in-process engine for SQLite and the tests: an inverted index from
+    every trigram of the lowered question and answer texts to the ids that
+    contain it. A term of three characters or more only verifies the ids
+    found in all of its trigram posting lists; shorter terms scan the
+    texts held in memory. Only the hits of the requested page are loaded
+    from the database.
+
+    Like QuizPool, the index follows the writes of this process through
+    the model change listeners and reloads after `ttl` seconds. As in
+    PrefixIndex, the writes notified during a reload are replayed on the
+    new index once it is swapped in.
+"""
+class InvertedIndexSearch:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._texts = {}
+        self._postings = {}
+        self._loaded_at = None
+        # (question id, question, answer) notified during a reload, the
+        # texts None once deleted
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        pass
+
+    @staticmethod
+    def _trigrams(value):
+        return {value[i:i + 3] for i in range(len(value) - 2)}
+
+    def _index(self, question_id, question, answer):
+        texts = ((question or '').lower(), (answer or '').lower())
+        self._texts[question_id] = texts
+        for trigram in self._trigrams(texts[0]) | self._trigrams(texts[1]):
+            self._postings.setdefault(trigram, set()).add(question_id)
+
+    def _unindex(self, question_id):
+        texts = self._texts.pop(question_id, None)
+        if texts is None:
+            return
+        for trigram in self._trigrams(texts[0]) | self._trigrams(texts[1]):
+            postings = self._postings.get(trigram)
+            if postings is not None:
+                postings.discard(question_id)
+                if not postings:
+                    del self._postings[trigram]
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            pending = self._pending = []
+        rows = db.session.query(Question.id, Question.question, Question.answer).all()
+        with self._lock:
+            self._texts = {}
+            self._postings = {}
+            for question_id, question, answer in rows:
+                self._index(question_id, question, answer)
+            self._loaded_at = time.monotonic()
+            for question_id, question, answer in pending:
+                self._unindex(question_id)
+                if question is not None:
+                    self._index(question_id, question, answer)
+            if self._pending is pending:
+                self._pending = None
+
+    def add(self, question):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question.id, question.question, question.answer))
+            if self._loaded_at is not None:
+                self._unindex(question.id)
+                self._index(question.id, question.question, question.answer)
+
+    def discard(self, question_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question_id, None, None))
+            self._unindex(question_id)
+
+    def reset(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ranked(self, term):
+        lowered = term.lower()
+        with self._lock:
+            trigrams = sorted((self._postings.get(trigram, ()) for trigram in self._trigrams(lowered)), key=len)
+            if trigrams:
+                candidates = set(trigrams[0]).intersection(*trigrams[1:])
+            else:
+                candidates = self._texts.keys()
+
+            ranked = []
+            for question_id in candidates:
+                question, answer = self._texts[question_id]
+                position = question.find(lowered)
+                if position >= 0:
+                    ranked.append((0, position + 1, question_id))
+                    continue
+                position = answer.find(lowered)
+                if position >= 0:
+                    ranked.append((1, position + 1, question_id))
+        ranked.sort()
+        return ranked
+
+    def search(self, term, after, offset, limit):
+        self._ensure_loaded()
+        ranked = self._ranked(term)
+        start = offset if after is None else bisect_right(ranked, tuple(after)) + offset
+        page = ranked[start:start + limit]
+
+        questions = {
+            row.id: row
+            for row in db.session.query(*Question.columns()).filter(Question.id.in_([rank[2] for rank in page]))
+        } if page else {}
+        return [(questions[rank[2]], rank) for rank in page if rank[2] in questions], len(ranked)
+
+
+def create_search_engine(app, prepare=True):
+    if db.get_engine(app).dialect.name == 'postgresql':
+        engine = TrigramSearch()
+    else:
+        engine = InvertedIndexSearch(app.config.get('SEARCH_INDEX_TTL', 300))
+    if prepare:
+        with app.app_context():
+            engine.prepare()
+    return engine
+
+
+@on_change
+def _follow_question_writes(action, instance):
+    if not is_change_of(instance, Question) or not has_app_context():
+        return
+    engine = current_app.extensions.get('search')
+    if not isinstance(engine, InvertedIndexSearch):
+        return
+    if action == 'bulk_insert':
+        engine.reset()
+    elif action == 'delete':
+        engine.discard(instance.id)
+    else:
+        engine.add(instance)
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Startup
+    StartupTimings records how long the app took to import and to build,
+    phase by phase, logs it once create_app() returns and renders it on
+    GET /metrics as the trivia_startup_seconds gauge.
+
+    With LAZY_STARTUP on, create_app() opens no database connection: the
+    work needing the database (the schema check and migrations, the search
+    indexes) is deferred and run once, by the first request or by
+    ensure_started(app) for code using the app outside a request. A
+    deferred step that fails is run again by the next request.
+"""
+
+logger = logging.getLogger(__name__)
+
+class StartupTimings:
+
+    def __init__(self, import_seconds=None):
+        self.phases = {}
+        if import_seconds is not None:
+            self.phases['import'] = import_seconds
+        self._deferred = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def defer(self, name, step):
+        self._deferred.append((name, step))
+
+    @property
+    def pending(self):
+        return bool(self._deferred)
+
+    def run_deferred(self):
+        with self._lock:
+            while self._deferred:
+                name, step = self._deferred[0]
+                with self.phase(name):
+                    step()
+                self._deferred.pop(0)
+                logger.info('deferred startup step %s took %.3fs', name, self.phases[name])
+
+    def built(self, started):
+        self.phases['create_app'] = time.perf_counter() - started
+        logger.info('app built: %s', self.report())
+
+    def report(self):
+        return ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in self.phases.items())
+
+    def render(self):
+        lines = [
+            '# HELP trivia_startup_seconds Time spent importing and building the app, by phase.',
+            '# TYPE trivia_startup_seconds gauge',
+        ]
+        for name, seconds in self.phases.items():
+            lines.append('trivia_startup_seconds{{phase="{}"}} {}'.format(name, round(seconds, 6)))
+        return '\n'.join(lines) + '\n'
+
+def ensure_started(app):
+    startup = app.extensions['startup']
+    if startup.pending:
+        with app.app_context():
+            startup.run_deferred()
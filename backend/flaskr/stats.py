@@ -0,0 +1,59 @@
+from sqlalchemy import func
+
+from migrations import STATS_TRIGGER_DIALECTS
+from models import db, Question, QuestionStats
+
+"""
+Question statistics
+    the number of questions per category and difficulty is kept in the
+    question_stats table by database triggers (see migrations.py), so the
+    totals of the listings and GET /categories/stats read a handful of rows
+    instead of counting the questions. Category and difficulty 0 stand for
+    questions without one. On databases without the triggers the questions
+    are counted.
+"""
+
+def counted_by_triggers():
+    return db.engine.dialect.name in STATS_TRIGGER_DIALECTS
+
+def total_questions(category=None):
+    if counted_by_triggers():
+        query = db.session.query(func.coalesce(func.sum(QuestionStats.questions), 0))
+        if category is not None:
+            query = query.filter(QuestionStats.category == category)
+    else:
+        query = db.session.query(func.count(Question.id))
+        if category is not None:
+            query = query.filter(Question.category == category)
+    return query.scalar()
+
+# (category, difficulty, questions) rows, 0 standing for none
+def _stats_rows():
+    if counted_by_triggers():
+        return db.session.query(QuestionStats.category, QuestionStats.difficulty, QuestionStats.questions)\
+            .filter(QuestionStats.questions > 0).order_by(QuestionStats.category, QuestionStats.difficulty)
+    category = func.coalesce(Question.category, 0)
+    difficulty = func.coalesce(Question.difficulty, 0)
+    return db.session.query(category, difficulty, func.count(Question.id))\
+        .group_by(category, difficulty).order_by(category, difficulty)
+
+def question_stats(categories):
+    by_category = {
+        category_id: {'id': category_id, 'type': type, 'total_questions': 0, 'difficulties': {}}
+        for category_id, type in categories.items()
+    }
+    difficulties = {}
+    total = 0
+    for category_id, difficulty, questions in _stats_rows():
+        total += questions
+        difficulties[difficulty] = difficulties.get(difficulty, 0) + questions
+        category = by_category.get(category_id)
+        if category is not None:
+            category['total_questions'] += questions
+            category['difficulties'][difficulty] = questions
+
+    return {
+        'total_questions': total,
+        'difficulties': dict(sorted(difficulties.items())),
+        'categories': list(by_category.values())
+    }
@@ -0,0 +1,29 @@
+from models import Question
+from .serialization import dumps
+
+"""
+stream_questions(query, head, batch_size)
+    encodes a whole question listing as one JSON object, chunk by chunk:
+    the fields of `head` first, then the questions read `batch_size` rows
+    at a time through a server-side cursor, then their total. Neither the
+    rows nor the document are ever held in memory at once, so time to first
+    byte and memory stay flat whatever the size of the listing. Only the
+    question columns are selected, as plain rows.
+"""
+def stream_questions(query, head, batch_size):
+    yield dumps(head)[:-1] + b',"questions":['
+
+    total = 0
+    chunk = []
+    rows = query.with_entities(*Question.columns())\
+        .execution_options(stream_results=True).yield_per(batch_size)
+    for row in rows:
+        chunk.append(dumps(Question.format_row(row)))
+        total += 1
+        if len(chunk) >= batch_size:
+            yield (b'' if total == len(chunk) else b',') + b','.join(chunk)
+            chunk = []
+    if chunk:
+        yield (b'' if total == len(chunk) else b',') + b','.join(chunk)
+
+    yield '],"total_questions":{}}}'.format(total).encode('ascii')
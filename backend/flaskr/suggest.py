@@ -0,0 +1,154 @@
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from sys import intern
+
+from flask import current_app, has_app_context
+
+from models import db, on_change, is_change_of, Question
+
+"""
+PrefixIndex
+    search-as-you-type completion held in memory: every lowered word of
+    every question sits in one sorted array of (token, question id) pairs,
+    kept as a list of interned strings and a parallel array of ids. A
+    prefix is a bisect to its first token followed by a short forward scan,
+    so suggestions never touch the database.
+
+    The last word of the typed prefix is completed; the words before it
+    must appear whole in the question. Suggestions come in the dictionary
+    order of the completed word (peanut before pear), then the older
+    questions first: the order of the index, so the scan stops at `limit`.
+
+    Like QuizPool, the index follows the writes of this process through the
+    model change listeners and reloads after `ttl` seconds. The writes
+    notified while a reload reads the questions are replayed on the new
+    index once it is swapped in, so none is lost to an older snapshot.
+"""
+class PrefixIndex:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._tokens = []
+        self._ids = array('q')
+        self._questions = {}
+        self._token_sets = {}
+        self._loaded_at = None
+        # (question id, text or None once deleted) notified during a reload
+        self._pending = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(value):
+        return [intern(token) for token in re.findall(r'\w+', (value or '').lower())]
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            pending = self._pending = []
+        rows = db.session.query(Question.id, Question.question).all()
+        pairs = []
+        questions = {}
+        token_sets = {}
+        for question_id, question in rows:
+            tokens = frozenset(self.tokenize(question))
+            questions[question_id] = question
+            token_sets[question_id] = tokens
+            pairs.extend((token, question_id) for token in tokens)
+        pairs.sort()
+
+        with self._lock:
+            self._tokens = [token for token, question_id in pairs]
+            self._ids = array('q', (question_id for token, question_id in pairs))
+            self._questions = questions
+            self._token_sets = token_sets
+            self._loaded_at = time.monotonic()
+            for question_id, question in pending:
+                self._remove(question_id)
+                if question is not None:
+                    self._insert(question_id, question)
+            if self._pending is pending:
+                self._pending = None
+
+    # ids are sorted within the run of a token, so (token, id) is two bisects
+    def _position(self, token, question_id):
+        low = bisect_left(self._tokens, token)
+        high = bisect_right(self._tokens, token, low)
+        return bisect_left(self._ids, question_id, low, high)
+
+    def add(self, question):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question.id, question.question))
+            if self._loaded_at is None:
+                return
+            self._remove(question.id)
+            self._insert(question.id, question.question)
+
+    def _insert(self, question_id, question):
+        tokens = frozenset(self.tokenize(question))
+        self._questions[question_id] = question
+        self._token_sets[question_id] = tokens
+        for token in tokens:
+            position = self._position(token, question_id)
+            self._tokens.insert(position, token)
+            self._ids.insert(position, question_id)
+
+    def discard(self, question_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((question_id, None))
+            self._remove(question_id)
+
+    def reset(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _remove(self, question_id):
+        self._questions.pop(question_id, None)
+        for token in self._token_sets.pop(question_id, ()):
+            position = self._position(token, question_id)
+            if position < len(self._ids) and self._ids[position] == question_id:
+                del self._tokens[position]
+                del self._ids[position]
+
+    def suggest(self, prefix, limit):
+        self._ensure_loaded()
+        words = self.tokenize(prefix)
+        if not words:
+            return []
+        last = words[-1]
+        required = set(words[:-1])
+
+        suggestions = []
+        found = set()
+        with self._lock:
+            position = bisect_left(self._tokens, last)
+            while position < len(self._tokens) and len(suggestions) < limit:
+                if not self._tokens[position].startswith(last):
+                    break
+                question_id = self._ids[position]
+                position += 1
+                if question_id in found or not required <= self._token_sets[question_id]:
+                    continue
+                found.add(question_id)
+                suggestions.append({'id': question_id, 'question': self._questions[question_id]})
+        return suggestions
+
+
+@on_change
+def _follow_question_writes(action, instance):
+    if not is_change_of(instance, Question) or not has_app_context():
+        return
+    index = current_app.extensions.get('suggest')
+    if index is None:
+        return
+    if action == 'bulk_insert':
+        index.reset()
+    elif action == 'delete':
+        index.discard(instance.id)
+    else:
+        index.add(instance)
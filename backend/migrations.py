@@ -0,0 +1,240 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+from sqlalchemy.exc import DBAPIError
+
+"""
+Schema migrations
+    run_migrations(db) brings an existing database up to the models, after
+    db.create_all() has created any missing table. Every migration below is
+    applied once, in order, and recorded in the schema_migrations table; each
+    one checks the schema first, so databases created from the current
+    models or restored from trivia.psql are simply marked as migrated.
+
+    Each migration runs in its own transaction, except those listed in
+    NON_TRANSACTIONAL, given an autocommit connection so they can build
+    indexes CONCURRENTLY. On Postgres the migrations run under an advisory
+    lock, so workers starting together do not race each other.
+"""
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_LOCK = 7263001
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', String(64), primary_key=True),
+    Column('applied_at', DateTime),
+)
+
+def _column_type(connection, table, column):
+    for info in inspect(connection).get_columns(table):
+        if info['name'] == column:
+            return info['type']
+    return None
+
+"""
+0001_question_category_integer_fk
+    questions.category used to be created as a VARCHAR compared with
+    str(category_id), while trivia.psql already declares it an integer
+    foreign key. Converts the column, clears categories that no longer
+    exist and adds the foreign key where it is missing.
+"""
+def _question_category_integer_fk(connection, metadata):
+    if connection.dialect.name == 'sqlite':
+        if isinstance(_column_type(connection, 'questions', 'category'), Integer):
+            return
+        # SQLite cannot change a column type: rebuild the table
+        connection.execute(text('ALTER TABLE questions RENAME TO questions_old'))
+        metadata.tables['questions'].create(connection)
+        connection.execute(text(
+            'INSERT INTO questions (id, question, answer, category, difficulty) '
+            'SELECT id, question, answer, CAST(NULLIF(category, \'\') AS INTEGER), difficulty '
+            'FROM questions_old'))
+        connection.execute(text('DROP TABLE questions_old'))
+    elif not isinstance(_column_type(connection, 'questions', 'category'), Integer):
+        connection.execute(text(
+            "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+            "USING NULLIF(category, '')::integer"))
+
+    connection.execute(text(
+        'UPDATE questions SET category = NULL '
+        'WHERE category IS NOT NULL AND category NOT IN (SELECT id FROM categories)'))
+
+    if connection.dialect.name != 'sqlite' and not inspect(connection).get_foreign_keys('questions'):
+        connection.execute(text(
+            'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+            'FOREIGN KEY (category) REFERENCES categories (id) '
+            'ON UPDATE CASCADE ON DELETE SET NULL'))
+
+"""
+0002_questions_category_id_index
+    composite (category, id) index serving the per-category listings, their
+    cursors and the quiz pools with index scans.
+"""
+def _questions_category_id_index(connection, metadata):
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)'))
+
+"""
+0003_quiz_session_category_integer
+    quiz sessions store the integer category as well. Sessions only live
+    for QUIZ_SESSION_TTL, so an old table is simply recreated.
+"""
+def _quiz_session_category_integer(connection, metadata):
+    if isinstance(_column_type(connection, 'quiz_sessions', 'category'), Integer):
+        return
+    connection.execute(text('DROP TABLE quiz_sessions'))
+    metadata.tables['quiz_sessions'].create(connection)
+
+"""
+0004_question_stats_triggers
+    question_stats holds the number of questions per category and
+    difficulty (0 standing for none), kept current by triggers on every
+    insert, delete and change of category or difficulty, whatever path the
+    write takes: the models, Question.bulk_insert(), the ON DELETE SET NULL
+    of a category or psql. The triggers are created before the counts are
+    filled in, in the same transaction, so no write falls in between.
+    Other databases get no triggers and flaskr.stats counts the questions.
+"""
+STATS_TRIGGER_DIALECTS = ('postgresql', 'sqlite')
+
+POSTGRES_STATS_TRIGGER = """
+CREATE OR REPLACE FUNCTION question_stats_follow() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE question_stats SET questions = questions - 1
+        WHERE category = COALESCE(OLD.category, 0) AND difficulty = COALESCE(OLD.difficulty, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO question_stats (category, difficulty, questions)
+        VALUES (COALESCE(NEW.category, 0), COALESCE(NEW.difficulty, 0), 1)
+        ON CONFLICT (category, difficulty) DO UPDATE SET questions = question_stats.questions + 1;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS questions_stats ON questions;
+CREATE TRIGGER questions_stats AFTER INSERT OR DELETE OR UPDATE OF category, difficulty ON questions
+FOR EACH ROW EXECUTE PROCEDURE question_stats_follow();
+"""
+
+SQLITE_STATS_COUNT = """
+    INSERT OR IGNORE INTO question_stats (category, difficulty, questions)
+    VALUES (COALESCE(NEW.category, 0), COALESCE(NEW.difficulty, 0), 0);
+    UPDATE question_stats SET questions = questions + 1
+    WHERE category = COALESCE(NEW.category, 0) AND difficulty = COALESCE(NEW.difficulty, 0);
+"""
+SQLITE_STATS_UNCOUNT = """
+    UPDATE question_stats SET questions = questions - 1
+    WHERE category = COALESCE(OLD.category, 0) AND difficulty = COALESCE(OLD.difficulty, 0);
+"""
+SQLITE_STATS_TRIGGERS = (
+    'CREATE TRIGGER IF NOT EXISTS questions_stats_insert AFTER INSERT ON questions BEGIN {} END'
+    .format(SQLITE_STATS_COUNT),
+    'CREATE TRIGGER IF NOT EXISTS questions_stats_delete AFTER DELETE ON questions BEGIN {} END'
+    .format(SQLITE_STATS_UNCOUNT),
+    'CREATE TRIGGER IF NOT EXISTS questions_stats_update AFTER UPDATE OF category, difficulty ON questions BEGIN {} {} END'
+    .format(SQLITE_STATS_UNCOUNT, SQLITE_STATS_COUNT),
+)
+
+def _question_stats_triggers(connection, metadata):
+    metadata.tables['question_stats'].create(connection, checkfirst=True)
+    if connection.dialect.name not in STATS_TRIGGER_DIALECTS:
+        logger.warning('no question_stats triggers for %s, the questions will be counted', connection.dialect.name)
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(POSTGRES_STATS_TRIGGER))
+    else:
+        for trigger in SQLITE_STATS_TRIGGERS:
+            connection.execute(text(trigger))
+
+    connection.execute(text('DELETE FROM question_stats'))
+    connection.execute(text(
+        'INSERT INTO question_stats (category, difficulty, questions) '
+        'SELECT COALESCE(category, 0), COALESCE(difficulty, 0), COUNT(*) FROM questions '
+        'GROUP BY COALESCE(category, 0), COALESCE(difficulty, 0)'))
+
+"""
+0005_quiz_session_difficulty
+    target difficulty of the adaptive quiz sessions, null for the others
+"""
+def _quiz_session_difficulty(connection, metadata):
+    if _column_type(connection, 'quiz_sessions', 'difficulty') is None:
+        connection.execute(text('ALTER TABLE quiz_sessions ADD COLUMN difficulty INTEGER'))
+
+"""
+0006_questions_trigram_indexes
+    Postgres only: the pg_trgm GIN indexes serving the ILIKE '%term%' of
+    TrigramSearch, built CONCURRENTLY so the questions stay writable on a
+    large table. An index left invalid by an interrupted build is rebuilt.
+    Without the privilege to create the extension the migration is logged
+    and recorded anyway, and the search scans the table; create pg_trgm
+    and delete the migration from schema_migrations to build them.
+"""
+TRIGRAM_INDEXES = {
+    'ix_questions_question_trgm': 'questions USING gin (question gin_trgm_ops)',
+    'ix_questions_answer_trgm': 'questions USING gin (answer gin_trgm_ops)',
+}
+
+def _questions_trigram_indexes(connection, metadata):
+    if connection.dialect.name != 'postgresql':
+        return
+    try:
+        connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    except DBAPIError as error:
+        logger.warning('pg_trgm unavailable, the search will scan the questions: %s', error.orig)
+        return
+
+    for name, definition in TRIGRAM_INDEXES.items():
+        valid = connection.execute(text(
+            'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), {'name': name}).scalar()
+        if valid is False:
+            connection.execute(text('DROP INDEX CONCURRENTLY {}'.format(name)))
+        connection.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'.format(name, definition)))
+
+MIGRATIONS = (
+    ('0001_question_category_integer_fk', _question_category_integer_fk),
+    ('0002_questions_category_id_index', _questions_category_id_index),
+    ('0003_quiz_session_category_integer', _quiz_session_category_integer),
+    ('0004_question_stats_triggers', _question_stats_triggers),
+    ('0005_quiz_session_difficulty', _quiz_session_difficulty),
+    ('0006_questions_trigram_indexes', _questions_trigram_indexes),
+)
+
+NON_TRANSACTIONAL = {'0006_questions_trigram_indexes'}
+
+def _record(connection, version):
+    connection.execute(schema_migrations.insert().values(version=version, applied_at=datetime.utcnow()))
+
+def run_migrations(db):
+    with db.engine.connect() as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        with connection.begin():
+            # a session lock, held across the transactions of the migrations
+            if postgres:
+                connection.execute(text('SELECT pg_advisory_lock({})'.format(MIGRATIONS_LOCK)))
+            schema_migrations.create(connection, checkfirst=True)
+            applied = {row.version for row in connection.execute(schema_migrations.select())}
+
+        try:
+            for version, migrate in MIGRATIONS:
+                if version in applied:
+                    continue
+                if version in NON_TRANSACTIONAL and postgres:
+                    # CONCURRENTLY waits for the open transactions: the one
+                    # holding the lock has committed above
+                    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as autocommit:
+                        migrate(autocommit, db.metadata)
+                    with connection.begin():
+                        _record(connection, version)
+                else:
+                    with connection.begin():
+                        migrate(connection, db.metadata)
+                        _record(connection, version)
+        finally:
+            if postgres:
+                with connection.begin():
+                    connection.execute(text('SELECT pg_advisory_unlock({})'.format(MIGRATIONS_LOCK)))
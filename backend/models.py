@@ -1,27 +1,68 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, DateTime, LargeBinary, ForeignKey, Index, create_engine
 import json
 
-from settings import DB_NAME, DB_PASSWORD, DB_USER,HOST_NAME
+from settings import DB_NAME, DB_PASSWORD, DB_USER,HOST_NAME, DATABASE_URI, DB_CREATE_ALL, DB_REPLICAS, LAZY_STARTUP
+from pooling import engine_options
+from routing import RoutingSQLAlchemy, init_replicas
 
 database_name = DB_NAME
-database_path = "postgresql://{}:{}@{}/{}".format(
+database_path = DATABASE_URI or "postgresql://{}:{}@{}/{}".format(
     DB_USER, DB_PASSWORD,HOST_NAME, database_name
 )
+replica_paths = DB_REPLICAS
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service with the pool
+    configured by pooling.engine_options(), routes the read-only handlers
+    to the replicas if any (see routing.py), then creates the schema unless
+    DB_CREATE_ALL is false
 """
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(database_path, app.config))
     db.app = app
     db.init_app(app)
+    init_replicas(app, db, replica_paths)
+    # with LAZY_STARTUP, create_app() defers create_schema() to the first request
+    if app.config.get("DB_CREATE_ALL", DB_CREATE_ALL) and not app.config.get("LAZY_STARTUP", LAZY_STARTUP):
+        create_schema()
+
+"""
+create_schema()
+    creates the missing tables and applies the pending schema migrations
+    (see migrations.py)
+"""
+def create_schema():
+    from migrations import run_migrations
+
     db.create_all()
+    run_migrations(db)
+
+"""
+Change listeners
+    functions called as listener(action, instance) once insert(), update()
+    or delete() has committed, so in-process indexes can follow the writes.
+    action is one of 'insert', 'update' or 'delete', or 'bulk_insert' with
+    the model class itself as instance after Question.bulk_insert().
+"""
+change_listeners = []
+
+def on_change(listener):
+    if listener not in change_listeners:
+        change_listeners.append(listener)
+    return listener
+
+def notify_change(action, instance):
+    for listener in change_listeners:
+        listener(action, instance)
+
+def is_change_of(instance, *models):
+    return isinstance(instance, models) or instance in models
 
 """
 Question
@@ -29,29 +70,52 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # per-category listings and quiz pools read (category, id) ranges
+    __table_args__ = (Index('ix_questions_category_id', 'category', 'id'),)
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
+    # Listings select these columns as plain rows and format them with
+    # format_row(), skipping the cost of building a Question per row.
+    FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+    @classmethod
+    def columns(cls):
+        return [getattr(cls, field) for field in cls.FIELDS]
+
+    @classmethod
+    def format_row(cls, row):
+        return dict(zip(cls.FIELDS, row))
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
         self.category = category
         self.difficulty = difficulty
 
+    @classmethod
+    def bulk_insert(cls, rows):
+        db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+        notify_change('bulk_insert', cls)
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_change('insert', self)
 
     def update(self):
         db.session.commit()
+        notify_change('update', self)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify_change('delete', self)
 
     def format(self):
         return {
@@ -62,6 +126,26 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+"""
+QuestionStats
+    number of questions per category and difficulty, 0 standing for none.
+    The rows are written by database triggers (see migrations.py), never
+    through the models.
+"""
+class QuestionStats(db.Model):
+    __tablename__ = 'question_stats'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    questions = Column(Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'category': self.category,
+            'difficulty': self.difficulty,
+            'questions': self.questions
+            }
+
 """
 Category
 
@@ -78,16 +162,70 @@ class Category(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_change('insert', self)
 
     def update(self):
         db.session.commit()
+        notify_change('update', self)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify_change('delete', self)
 
     def format(self):
         return {
             'id': self.id,
             'type': self.type
             }
+
+"""
+QuizSession
+    server-side state of a quiz game: the category played, the ids already
+    served, kept as a compressed bitmap (see flaskr.quiz.SeenBitmap), and
+    the target difficulty of an adaptive game
+"""
+class QuizSession(db.Model):
+    __tablename__ = 'quiz_sessions'
+
+    id = Column(String(32), primary_key=True)
+    category = Column(Integer)
+    seen = Column(LargeBinary)
+    rounds = Column(Integer)
+    expires_at = Column(DateTime, index=True)
+    difficulty = Column(Integer)
+
+    # every update checks that no other request has played a round since
+    # the session was read, see flaskr.quiz.next_in_session()
+    __mapper_args__ = {'version_id_col': rounds, 'version_id_generator': False}
+
+    def __init__(self, id, category, seen, expires_at, difficulty=None):
+        self.id = id
+        self.category = category
+        self.seen = seen
+        self.rounds = 0
+        self.expires_at = expires_at
+        self.difficulty = difficulty
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+        notify_change('insert', self)
+
+    def update(self):
+        db.session.commit()
+        notify_change('update', self)
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+        notify_change('delete', self)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'category': self.category,
+            'rounds': self.rounds,
+            'difficulty': self.difficulty,
+            'expires_at': self.expires_at.isoformat()
+            }
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+import settings
+
+"""
+Connection pool
+    engine_options(uri, config) builds the SQLALCHEMY_ENGINE_OPTIONS of an
+    app from its config, falling back on settings.py (and so on the
+    environment):
+
+        DB_POOL_SIZE          connections kept open by each worker
+        DB_MAX_OVERFLOW       extra connections opened under load
+        DB_POOL_TIMEOUT       seconds a request waits for a free connection
+        DB_POOL_RECYCLE       seconds after which a connection is replaced
+        DB_POOL_PRE_PING      test connections before handing them out
+        DB_STATEMENT_TIMEOUT  milliseconds before Postgres cancels a
+                              statement, 0 for no limit
+
+    Every worker opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so
+    size them with the number of workers and max_connections in mind.
+    SQLite keeps the pools SQLAlchemy picks for it and ignores the options.
+"""
+
+logger = logging.getLogger(__name__)
+
+# checkouts slower than this many seconds are logged with the pool status
+SLOW_CHECKOUT = 0.1
+
+"""
+MeteredQueuePool
+    a QueuePool counting its checkouts and the time spent waiting for them
+"""
+class MeteredQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            waited = time.perf_counter() - started
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            if waited > SLOW_CHECKOUT:
+                logger.warning('waited %.3fs for a database connection: %s', waited, self.status())
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                'pool': type(self).__name__,
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                'checkouts': self.checkouts,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+            }
+
+def engine_options(uri, config):
+    def option(name):
+        return config.get(name, getattr(settings, name))
+
+    if make_url(uri).get_backend_name() == 'sqlite':
+        return {}
+
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': option('DB_POOL_SIZE'),
+        'max_overflow': option('DB_MAX_OVERFLOW'),
+        'pool_timeout': option('DB_POOL_TIMEOUT'),
+        'pool_recycle': option('DB_POOL_RECYCLE'),
+        'pool_pre_ping': option('DB_POOL_PRE_PING'),
+    }
+    timeout = statement_timeout(uri, config)
+    if timeout is not None:
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(timeout)}
+    return options
+
+# DB_STATEMENT_TIMEOUT in milliseconds, None without a limit or off Postgres
+def statement_timeout(uri, config):
+    timeout = config.get('DB_STATEMENT_TIMEOUT', settings.DB_STATEMENT_TIMEOUT)
+    if timeout and make_url(uri).get_backend_name() == 'postgresql':
+        return int(timeout)
+    return None
+
+def pool_metrics(engine):
+    if isinstance(engine.pool, MeteredQueuePool):
+        return engine.pool.metrics()
+    return {'pool': type(engine.pool).__name__, 'status': engine.pool.status()}
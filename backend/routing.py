@@ -0,0 +1,109 @@
+import itertools
+import logging
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+from sqlalchemy.exc import DBAPIError
+
+from pooling import engine_options, pool_metrics
+
+"""
+Read replicas
+    The handlers marked @read_only run their queries on a replica when
+    SQLALCHEMY_REPLICA_URIS (or DB_REPLICAS in settings.py) names some;
+    every other handler, and so every write and every quiz session, runs
+    on the primary database.
+
+    A read-only request takes one connection from the next replica in
+    turn the first time it queries, and keeps it until it ends. A replica
+    that cannot be reached is skipped for REPLICA_RETRY seconds (default
+    30); when none is available the request reads from the primary.
+"""
+
+logger = logging.getLogger(__name__)
+
+def read_only(view):
+    view.read_only = True
+    return view
+
+class Replica:
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.down_until = 0.0
+
+    def healthy(self):
+        return self.down_until <= time.monotonic()
+
+class ReplicaSet:
+
+    def __init__(self, uris, config):
+        self.replicas = [Replica(create_engine(uri, **engine_options(uri, config))) for uri in uris]
+        self.retry = config.get('REPLICA_RETRY', 30)
+        self._turns = itertools.count()
+
+    def connect(self):
+        start = next(self._turns)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if not replica.healthy():
+                continue
+            try:
+                return replica.engine.connect()
+            except DBAPIError as error:
+                replica.down_until = time.monotonic() + self.retry
+                logger.warning('replica %r unavailable for %ss: %s', replica.engine.url, self.retry, error.orig)
+        return None
+
+    def metrics(self):
+        return [
+            dict(pool_metrics(replica.engine), healthy=replica.healthy())
+            for replica in self.replicas
+        ]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+"""
+RoutingSession
+    the Flask-SQLAlchemy session, bound to the connection of the request's
+    replica for the queries of a read-only handler
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context():
+            connection = replica_connection(self.app)
+            if connection is not None:
+                return connection
+        return super().get_bind(mapper, clause)
+
+def replica_connection(app):
+    if 'replica_connection' not in g:
+        replicas = app.extensions.get('replicas')
+        view = app.view_functions.get(request.endpoint)
+        if replicas is not None and getattr(view, 'read_only', False):
+            g.replica_connection = replicas.connect()
+        else:
+            g.replica_connection = None
+    return g.replica_connection
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+def init_replicas(app, db, uris):
+    if not uris:
+        return
+    app.extensions['replicas'] = ReplicaSet(uris, app.config)
+
+    @app.teardown_request
+    def release_replica_connection(error=None):
+        connection = g.pop('replica_connection', None)
+        if connection is not None:
+            db.session.remove()
+            connection.close()
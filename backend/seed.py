@@ -0,0 +1,69 @@
+import os
+import re
+
+from sqlalchemy import func, text
+
+from models import db, notify_change, Question, Category
+
+"""
+Seed data
+    seed_database() fills an empty database with the categories and
+    questions of trivia.psql, read from its COPY blocks, so a SQLite
+    database (in memory for the tests, or a file for local benchmarks)
+    starts from the same rows as a Postgres one restored with psql.
+"""
+
+TRIVIA_PSQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')
+
+COPY_BLOCK = re.compile(r'^COPY public\.(\w+) \(([^)]*)\) FROM stdin;\n(.*?)^\\\.$', re.M | re.S)
+COPY_ESCAPES = re.compile(r'\\(.)')
+COPY_ESCAPED = {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}
+
+def _copy_value(value, column):
+    if value == '\\N':
+        return None
+    value = COPY_ESCAPES.sub(lambda match: COPY_ESCAPED.get(match.group(1), match.group(1)), value)
+    return column.type.python_type(value)
+
+"""
+read_psql(path)
+    the rows of the COPY blocks of a pg_dump, as {table: [row dicts]}, for
+    the tables of the models
+"""
+def read_psql(path=TRIVIA_PSQL):
+    with open(path, encoding='utf-8') as dump:
+        content = dump.read()
+
+    tables = {}
+    for name, columns, data in COPY_BLOCK.findall(content):
+        table = db.metadata.tables.get(name)
+        if table is None:
+            continue
+        names = [column.strip() for column in columns.split(',')]
+        tables[name] = [
+            {
+                column: _copy_value(value, table.columns[column])
+                for column, value in zip(names, line.split('\t'))
+            }
+            for line in data.splitlines()
+        ]
+    return tables
+
+def seed_database(path=TRIVIA_PSQL):
+    if db.session.query(Question.id).first() is not None or db.session.query(Category.id).first() is not None:
+        return False
+
+    tables = read_psql(path)
+    for model in (Category, Question):
+        rows = tables.get(model.__tablename__)
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+    if db.engine.dialect.name == 'postgresql':
+        # the ids were given, so move the sequences past them
+        for model in (Category, Question):
+            db.session.execute(text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), :last_id, true)"
+            ), {'table': model.__tablename__, 'last_id': db.session.query(func.max(model.id)).scalar() or 1})
+    db.session.commit()
+    notify_change('bulk_insert', Question)
+    return True
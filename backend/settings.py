@@ -1,7 +1,21 @@
 import os
-from dotenv import load_dotenv
 
-load=load_dotenv()
+#Variables of the first .env found from this folder up, as python-dotenv's
+#find_dotenv() would, only importing python-dotenv when there is one:
+def find_env_file():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(folder, ".env")
+        if os.path.isfile(path):
+            return path
+        if os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+env_file = find_env_file()
+if env_file is not None:
+    from dotenv import load_dotenv
+    load = load_dotenv(env_file)
 
 #Connection to Database trivia:
 DB_NAME = os.environ.get("DB_NAME")
@@ -9,8 +23,41 @@ DB_USER=os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 HOST_NAME=os.environ.get("HOST_NAME")
 
+#URI of the database trivia instead of the connection above, for instance
+#sqlite:////tmp/trivia.db for local benchmarks (fill it with `flask seed-db`):
+DATABASE_URI = os.environ.get("DATABASE_URI")
+
+#Read replicas of the database trivia, comma separated URIs (see routing.py):
+DB_REPLICAS = [uri.strip() for uri in os.environ.get("DB_REPLICAS", "").split(",") if uri.strip()]
+
+#Connection pool of each worker (see pooling.py):
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0))
+
+#Create the missing tables and migrate the schema when the app starts,
+#set to false when `flask init-db` is run once before starting the workers:
+DB_CREATE_ALL = os.environ.get("DB_CREATE_ALL", "true").lower() == "true"
+
+#Defer the schema check and every database connection from create_app()
+#to the first request (see flaskr/startup.py):
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP", "false").lower() == "true"
+
+#Key used to sign the pagination cursors; the default is public, so the
+#app warns when it is used outside debug and testing:
+DEFAULT_SECRET_KEY = "dev"
+SECRET_KEY = os.environ.get("SECRET_KEY", DEFAULT_SECRET_KEY)
+
 #Connection to Database  trivia_test:
 DB_NAME1 = os.environ.get("DB_NAME1")
 DB_USER1=os.environ.get("DB_USER1")
 DB_PASSWORD1 = os.environ.get("DB_PASSWORD1")
-HOST_NAME1=os.environ.get("HOST_NAME1")
\ No newline at end of file
+HOST_NAME1=os.environ.get("HOST_NAME1")
+
+#Database of the tests when set, for instance sqlite:////tmp/trivia_test.db;
+#otherwise trivia_test above when DB_NAME1 is set, else an in-memory SQLite
+#database seeded from trivia.psql:
+TEST_DATABASE_URI = os.environ.get("TEST_DATABASE_URI")
\ No newline at end of file
@@ -1,37 +1,185 @@
 import os
+import re
 from re import search
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import time
+import asyncio
+import importlib.util
+import tempfile
+import threading
+from contextlib import contextmanager
+from itsdangerous import URLSafeSerializer
+from sqlalchemy import event, func, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
 
-from flaskr import create_app
-from models import setup_db, Question, Category
-from settings import DB_NAME1, DB_PASSWORD1, DB_USER1, HOST_NAME1
+from flaskr import create_app, reset_state, QUESTIONS_PER_PAGE
+from flaskr.search import InvertedIndexSearch
+from flaskr.quiz import QuizPool, SeenBitmap, DIFFICULTIES, load_session, next_in_session
+from flaskr.startup import ensure_started
+from models import db, Question, Category, QuestionStats, QuizSession
+from migrations import MIGRATIONS
+from seed import seed_database
+from settings import DB_NAME1, DB_PASSWORD1, DB_USER1, HOST_NAME1, TEST_DATABASE_URI
+
+# TEST_DATABASE_URI, else the trivia_test Postgres database when DB_NAME1 is
+# set, else an in-memory SQLite database; either is seeded from trivia.psql
+# when empty
+if TEST_DATABASE_URI:
+    database_path = TEST_DATABASE_URI
+elif DB_NAME1:
+    database_path = "postgresql://{}:{}@{}/{}".format(DB_USER1, DB_PASSWORD1, HOST_NAME1, DB_NAME1)
+else:
+    database_path = "sqlite://"
+on_postgres = database_path.startswith('postgresql')
+
+
+class QueryBudget:
+    """Records the SQL statements run while it is active, and the rows each one returns.
+
+    Drivers that do not report the rows of a SELECT (SQLite) get them
+    counted by running the statement again wrapped in a COUNT(*). The
+    savepoints isolating each test are not counted.
+    """
+
+    TEST_TRANSACTION = re.compile(r'\s*(BEGIN|(RELEASE |ROLLBACK TO )?SAVEPOINT \w+)\s*$', re.I)
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(Engine, 'after_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'after_cursor_execute', self.record)
+
+    def record(self, connection, cursor, statement, parameters, context, executemany):
+        if self.TEST_TRANSACTION.match(statement):
+            return
+        rows = 0
+        if cursor.description is not None and statement.lstrip().upper().startswith('SELECT'):
+            rows = cursor.rowcount
+            if rows < 0:
+                counter = cursor.connection.cursor()
+                counter.execute('SELECT COUNT(*) FROM ({}) AS budget'.format(statement), parameters)
+                rows = counter.fetchone()[0]
+                counter.close()
+        self.statements.append((statement, rows))
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    @property
+    def rows(self):
+        return sum(rows for statement, rows in self.statements)
+
+    def report(self):
+        return '{} queries, {} rows:\n'.format(self.queries, self.rows) + '\n'.join(
+            '  [{} rows] {}'.format(rows, ' '.join(statement.split())) for statement, rows in self.statements)
+
+
+def _sqlite_without_implicit_transactions(dbapi_connection, connection_record):
+    # pysqlite opens and commits transactions on its own, which breaks the
+    # savepoints isolating the tests: leave them to SQLAlchemy
+    dbapi_connection.isolation_level = None
+
+def _sqlite_begin(connection):
+    connection.exec_driver_sql('BEGIN')
+
+def create_test_app(database_path, **config):
+    """Builds an app with its schema and the rows of trivia.psql, the app of the test session by default"""
+    app = create_app(dict(config, SQLALCHEMY_DATABASE_URI=database_path, LAZY_STARTUP=True))
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_without_implicit_transactions)
+        event.listen(engine, 'begin', _sqlite_begin)
+    ensure_started(app)
+    with app.app_context():
+        seed_database()
+    return app
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    # app of the whole test session, built with its schema by the first test
+    shared_app = None
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
+        """Define test variables, get the app of the test session and open the transaction of the test."""
         self.database_name =DB_NAME1
-        self.database_path = "postgresql://{}:{}@{}/{}".format(
-            DB_USER1, DB_PASSWORD1,HOST_NAME1, self.database_name
-        )
-        setup_db(self.app, self.database_path)
+        self.database_path = database_path
+        if TriviaTestCase.shared_app is None:
+            TriviaTestCase.shared_app = create_test_app(self.database_path)
+        self.app = TriviaTestCase.shared_app
+        self.client = self.app.test_client
+        self.db = db
+        # the tests building an app of their own made it the default one
+        db.app = self.app
 
-        # binds the app to the current context
+        # Everything the test writes is rolled back by tearDown: the session
+        # is bound to a connection inside a transaction, and the commits and
+        # rollbacks of the handlers only end a savepoint, started again
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.app_session = db.session
+        db.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+        event.listen(db.session, 'after_transaction_end', self.restart_savepoint)
+        reset_state(self.app)
+
+    def restart_savepoint(self, session, transaction):
+        if not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        event.remove(db.session, 'after_transaction_end', self.restart_savepoint)
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+
+    @contextmanager
+    def outsideTestTransaction(self):
+        """Gives the block the session of the apps, for apps built on other databases than the test one"""
+        test_session = db.session
+        db.session = self.app_session
+        try:
+            yield
+        finally:
+            db.session.remove()
+            db.session = test_session
+            db.app = self.app
+
+    @contextmanager
+    def writtenDuringFirstQuery(self, write):
+        """Calls write() once the first SQL statement of the block has run, as a concurrent writer would"""
+        writes = []
+
+        def concurrent_write(*args):
+            if not writes:
+                writes.append(True)
+                write()
+
+        event.listen(Engine, 'after_cursor_execute', concurrent_write)
+        try:
+            yield
+        finally:
+            event.remove(Engine, 'after_cursor_execute', concurrent_write)
+        self.assertTrue(writes)
+
+    @contextmanager
+    def assertQueryBudget(self, queries, rows):
+        """Fails when the requests of the block run more SQL statements or fetch more rows than given"""
+        with QueryBudget() as budget:
+            yield budget
+        self.assertLessEqual(budget.queries, queries, budget.report())
+        self.assertLessEqual(budget.rows, rows, budget.report())
 
     """
     TODO
@@ -39,15 +187,54 @@ class TriviaTestCase(unittest.TestCase):
     """
     #block for categories create test unit for page and specific category errors
     def test_get_available_categories(self):
-        res = self.client().get('/categories')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def test_get_category_stats(self):
+        stats_rows = QuestionStats.query.filter(QuestionStats.questions > 0).count()
+        # the categories, then the stats rows, never the questions
+        with self.assertQueryBudget(queries=2, rows=Category.query.count() + stats_rows):
+            res = self.client().get('/categories/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertEqual(sum(data['difficulties'].values()), Question.query.count())
+        for category in data['categories']:
+            self.assertEqual(category['total_questions'],
+                             Question.query.filter_by(category=category['id']).count())
+
+    def test_category_stats_follow_writes(self):
+        def stats():
+            data = json.loads(self.client().get('/categories/stats').data)
+            data['categories'] = {category['id']: category for category in data['categories']}
+            return data
+
+        before = stats()
+        res = self.client().post('/questions', json={
+            'question': 'What is the capital of Peru?', 'answer': 'Lima', 'category': 3, 'difficulty': 5})
+        question_id = json.loads(res.data)['question_id']
+        self.client().post('/questions/bulk', content_type='application/x-ndjson', data=json.dumps(
+            {'question': 'What is the capital of Chile?', 'answer': 'Santiago', 'category': 3, 'difficulty': 5}))
+        after = stats()
+        self.assertEqual(after['total_questions'], before['total_questions'] + 2)
+        self.assertEqual(after['difficulties']['5'], before['difficulties'].get('5', 0) + 2)
+        self.assertEqual(after['categories'][3]['total_questions'], before['categories'][3]['total_questions'] + 2)
+
+        self.client().delete('/questions/{}'.format(question_id))
+        self.assertEqual(stats()['total_questions'], before['total_questions'] + 1)
+        self.assertEqual(json.loads(self.client().get('/questions').data)['total_questions'],
+                         before['total_questions'] + 1)
+
     def test_get_specific_categorie(self):
-        res = self.client().get('/categories/1')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories/1')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -55,7 +242,8 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categorie'])
 
     def test_get_specific_categorie_not_found_req(self):
-        res = self.client().get('/categories/400')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories/400')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -63,7 +251,8 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'resource not found')
 
     def test_404_sent_requesting_beyond_valid_page_categorie(self):
-        res = self.client().get('/categories?page=1000')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories?page=1000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -71,7 +260,8 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], "resource not found")
     
     def test_404_sent_requesting_beyond_valid_specific_categorie(self):
-        res = self.client().get('/categories/200')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories/200')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -82,14 +272,43 @@ class TriviaTestCase(unittest.TestCase):
         newCategory = {
             'type': 'Culture',
         }
-        res = self.client().post('/categories', json=newCategory)
+        with self.assertQueryBudget(queries=2, rows=1):
+            res = self.client().post('/categories', json=newCategory)
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 201)
         self.assertEqual(data["success"], True)
 
+    def test_add_category_refreshes_cached_categories(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+
+        res = self.client().post('/categories', json={'type': 'Music'})
+        type_id = json.loads(res.data)['type_id']
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories'][str(type_id)], 'Music')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_categories_loaded_during_a_write_are_not_kept(self):
+        cache = self.app.extensions['categories']
+
+        with self.app.app_context():
+            # a category write of another thread lands while the map loads
+            with self.writtenDuringFirstQuery(cache.invalidate):
+                cache.categories()
+            # reloaded once, then kept
+            with QueryBudget() as budget:
+                cache.categories()
+                cache.categories()
+            self.assertEqual(budget.queries, 1)
+
     # block for questions create test unit for page and specific question 
     def test_get_paginated_questions(self):
-        res = self.client().get('/questions')
+        # the categories, the total and a page plus one row telling if another follows
+        with self.assertQueryBudget(queries=3, rows=Category.query.count() + 1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().get('/questions')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -97,15 +316,272 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['questions'])
     
+    def test_get_questions_after_id(self):
+        with self.assertQueryBudget(queries=3, rows=Category.query.count() + 1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().get('/questions?after_id=20')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(question['id'] > 20 for question in data['questions']))
+
+    def test_get_questions_with_cursor(self):
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        self.assertTrue(first_page['next_cursor'])
+
+        with self.assertQueryBudget(queries=2, rows=1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().get('/questions?cursor=' + first_page['next_cursor'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertGreater(data['questions'][0]['id'], first_page['questions'][-1]['id'])
+
+    def test_400_sent_with_tampered_cursor(self):
+        res = self.client().get('/questions')
+        cursor = json.loads(res.data)['next_cursor']
+
+        res = self.client().get('/categories/1/questions?cursor=' + cursor)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_304_sent_for_unchanged_questions(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+        self.assertTrue(res.headers['Cache-Control'])
+
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        self.client().post('/questions', json={
+            'question': 'Which planet is the largest?', 'answer': 'Jupiter', 'difficulty': 1, 'category': 1})
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_response_cache_invalidated_by_writes(self):
+        res = self.client().get('/questions?page=1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = self.client().get('/questions?page=1')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        total_questions = json.loads(res.data)['total_questions']
+
+        self.client().post('/questions', json={
+            'question': 'What is the capital of Kenya?', 'answer': 'Nairobi', 'difficulty': 1, 'category': 3})
+        res = self.client().get('/questions?page=1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['total_questions'], total_questions + 1)
+
+    def test_response_cache_does_not_store_a_body_read_before_a_write(self):
+        def concurrent_write():
+            self.app.extensions['data_version'].bump()
+            self.app.extensions['response_cache'].invalidate()
+
+        # the write of another thread commits while the listing runs
+        with self.writtenDuringFirstQuery(concurrent_write):
+            res = self.client().get('/questions?page=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Cache', res.headers)
+
+        res = self.client().get('/questions?page=1')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+
+    def test_400_sent_with_signed_cursor_of_wrong_shape(self):
+        with self.app.app_context():
+            serializer = URLSafeSerializer(self.app.config['SECRET_KEY'], salt='trivia-cursor')
+            listing_cursors = [
+                serializer.dumps({'scope': 'questions', 'keys': [1, 2]}),
+                serializer.dumps({'scope': 'questions'}),
+                serializer.dumps(['questions', 1]),
+            ]
+            search_cursor = serializer.dumps({'scope': 'search:What', 'keys': 5})
+
+        for cursor in listing_cursors:
+            res = self.client().get('/questions?cursor=' + cursor)
+            self.assertEqual(res.status_code, 400)
+        res = self.client().post('/questions/searchTerm', json={'searchTerm': 'What', 'cursor': search_cursor})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['message'], 'bad request')
+
+    def test_default_secret_key_warned_outside_testing(self):
+        config = {'SQLALCHEMY_DATABASE_URI': self.database_path, 'LAZY_STARTUP': True, 'SECRET_KEY': 'dev'}
+        with self.assertLogs('flaskr', 'WARNING') as logs:
+            create_app(config)
+        self.assertIn('SECRET_KEY', logs.output[0])
+        with self.assertNoLogs('flaskr', 'WARNING'):
+            create_app(dict(config, TESTING=True))
+            create_app(dict(config, SECRET_KEY='a key of this deployment'))
+
+    def test_response_cache_ignores_a_cursor_sent_in_a_get_body(self):
+        first_page = json.loads(self.client().get('/questions').data)
+        self.client().application.extensions['response_cache'].invalidate()
+
+        res = self.client().get('/questions', json={'cursor': first_page['next_cursor']})
+        self.assertEqual(json.loads(res.data)['questions'], first_page['questions'])
+        res = self.client().get('/questions')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(res.data)['questions'], first_page['questions'])
+
+    def test_get_all_questions_streamed(self):
+        # the categories, then a single pass over the questions of the category
+        with self.assertQueryBudget(queries=2, rows=Category.query.count() + Question.query.filter_by(category=1).count()):
+            res = self.client().get('/categories/1/questions?page_size=all&stream=1')
+            data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['current_category'], 'Science')
+        self.assertEqual(data['total_questions'], Question.query.filter_by(category=1).count())
+        self.assertEqual(len(data['questions']), data['total_questions'])
+
+    def test_questions_category_is_an_integer(self):
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(question['category'] == 1 for question in data['questions']))
+        with self.app.app_context():
+            versions = sorted(row[0] for row in self.db.session.execute('SELECT version FROM schema_migrations'))
+        self.assertEqual(versions, sorted(version for version, migrate in MIGRATIONS))
+
+    def test_400_sent_requesting_all_questions_without_stream(self):
+        res = self.client().get('/questions?page_size=all')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_request_metrics(self):
+        timed_app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'SERVER_TIMING': True})
+        client = timed_app.test_client()
+        res = client.get('/questions?page=1')
+        self.assertRegex(res.headers['Server-Timing'], r'^db;desc="[1-9]\d* queries, \d+ rows";dur=[\d.]+, total;dur=[\d.]+$')
+
+        res = client.get('/metrics')
+        metrics = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('trivia_requests_total{endpoint="retrieve_questions",method="GET",status="200"} 1', metrics)
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="retrieve_questions",method="GET"} 1', metrics)
+        self.assertIn('trivia_request_sql_queries_bucket{endpoint="retrieve_questions",method="GET",le="+Inf"} 1', metrics)
+        self.assertIn('# TYPE trivia_response_size_bytes histogram', metrics)
+
+    @unittest.skipUnless(on_postgres, 'the pool is only metered on Postgres')
+    def test_get_pool_metrics(self):
+        with self.assertQueryBudget(queries=0, rows=0):
+            res = self.client().get('/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['pool']['pool'], 'MeteredQueuePool')
+        self.assertGreaterEqual(data['pool']['checkouts'], 1)
+        self.assertLessEqual(data['pool']['checked_out'], data['pool']['size'] + data['pool']['max_overflow'])
+
+    def test_lazy_startup_defers_database_work(self):
+        connections = []
+
+        def count_connection(dbapi_connection, connection_record):
+            connections.append(dbapi_connection)
+
+        event.listen(Pool, 'connect', count_connection)
+        try:
+            lazy_app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'LAZY_STARTUP': True})
+            self.assertEqual(connections, [])
+            self.assertTrue(lazy_app.extensions['startup'].pending)
+
+            res = lazy_app.test_client().get('/questions?page=1')
+        finally:
+            event.remove(Pool, 'connect', count_connection)
+            db.app = self.app
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(connections)
+        self.assertFalse(lazy_app.extensions['startup'].pending)
+
+        metrics = lazy_app.test_client().get('/metrics').data.decode('utf-8')
+        for phase in ('import', 'setup_db', 'create_app', 'create_schema'):
+            self.assertIn('trivia_startup_seconds{{phase="{}"}}'.format(phase), metrics)
+
+    @unittest.skipUnless(on_postgres, 'the replicas are Postgres databases')
+    def test_read_only_endpoints_fall_back_on_primary_without_replica(self):
+        replicated_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_REPLICA_URIS': [self.database_path, 'postgresql://nobody@127.0.0.1:1/nothing'],
+            'RESPONSE_CACHE': None,
+        })
+        client = replicated_app.test_client()
+        for _ in range(2):
+            res = client.get('/questions?page=1')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['success'], True)
+
+        res = client.post('/questions', json={'question': 'Replicated?', 'answer': 'Yes', 'category': 1, 'difficulty': 1})
+        self.assertEqual(res.status_code, 201)
+        Question.query.get(json.loads(res.data)['question_id']).delete()
+
+        data = json.loads(client.get('/pool').data)
+        self.assertEqual([replica['healthy'] for replica in data['replicas']], [True, False])
+
+    def test_read_only_endpoints_read_from_the_replica(self):
+        with tempfile.TemporaryDirectory() as tmp, self.outsideTestTransaction():
+            primary_path = 'sqlite:///' + os.path.join(tmp, 'primary.db')
+            replica_path = 'sqlite:///' + os.path.join(tmp, 'replica.db')
+            replica_app = create_test_app(replica_path)
+            with replica_app.app_context():
+                first_id = db.session.query(func.min(Question.id)).scalar()
+                db.session.execute(text("UPDATE questions SET question = 'REPLICA' WHERE id = :id"), {'id': first_id})
+                db.session.commit()
+            replicated_app = create_test_app(primary_path, SQLALCHEMY_REPLICA_URIS=[replica_path], RESPONSE_CACHE=None)
+            client = replicated_app.test_client()
+
+            res = client.get('/questions?page=1')
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['questions'][0]['question'], 'REPLICA')
+
+            res = client.post('/questions', json={'question': 'Replicated?', 'answer': 'Yes', 'category': 1, 'difficulty': 1})
+            self.assertEqual(res.status_code, 201)
+            question_id = json.loads(res.data)['question_id']
+            with replicated_app.app_context():
+                self.assertEqual(Question.query.get(question_id).question, 'Replicated?')
+                self.assertNotEqual(Question.query.get(first_id).question, 'REPLICA')
+            with replica_app.app_context():
+                self.assertIsNone(Question.query.get(question_id))
+
+            for app in (replicated_app, replica_app):
+                with app.app_context():
+                    db.get_engine(app).dispose()
+            replicated_app.extensions['replicas'].dispose()
+
+    def test_json_encoders_send_the_same_questions(self):
+        standard_app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'JSON_ENCODER': 'json'})
+        res = standard_app.test_client().get('/questions?page=1')
+        expected = json.loads(res.data)
+
+        res = self.client().get('/questions?page=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'], expected['questions'])
+        self.assertEqual(set(data['questions'][0]), set(Question.FIELDS))
+
     def test_get_specific_question_method_not_allowed_req(self):
-        res = self.client().get('/questions/4')
+        with self.assertQueryBudget(queries=0, rows=0):
+            res = self.client().get('/questions/4')
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 405)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
 
     def test_404_sent_requesting_beyond_valid_page_question(self):
-        res = self.client().get('/questions?page=1000')
+        with self.assertQueryBudget(queries=1, rows=0):
+            res = self.client().get('/questions?page=1000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -124,7 +600,9 @@ class TriviaTestCase(unittest.TestCase):
         question = Question.query.order_by(self.db.desc(Question.id)).first()
         self.assertNotEqual(question, None)
         question_id =question.id
-        res = self.client().delete('/questions/'+str(question_id))
+        # the question, then the total and first page sent back
+        with self.assertQueryBudget(queries=4, rows=1 + 1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().delete('/questions/'+str(question_id))
         data = json.loads(res.data)
         question = Question.query.get(question_id)
         self.assertEqual(res.status_code, 200)
@@ -140,14 +618,82 @@ class TriviaTestCase(unittest.TestCase):
             'difficulty': 2,
             'category': 1,
         }
-        res = self.client().post('/questions', json=newQuestion)
+        with self.assertQueryBudget(queries=4, rows=1 + 1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().post('/questions', json=newQuestion)
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 201)
         self.assertEqual(data["success"], True)
 
+    def test_add_question_minimal_response(self):
+        newQuestion = {
+            'question': 'What is the capital of Ghana?',
+            'answer': 'Accra',
+            'difficulty': 1,
+            'category': 3,
+        }
+        with self.assertQueryBudget(queries=2, rows=1):
+            res = self.client().post('/questions?return=minimal', json=newQuestion)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        self.assertNotIn('questions', data)
+
+        with self.assertQueryBudget(queries=2, rows=1):
+            res = self.client().delete('/questions/{}'.format(data['question_id']),
+                                       headers={'Prefer': 'return=minimal'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertNotIn('total_questions', data)
+
+    def test_bulk_import_questions(self):
+        body = '\n'.join([
+            json.dumps({'question': 'What is the capital of Peru?', 'answer': 'Lima', 'category': 3, 'difficulty': 1}),
+            json.dumps({'question': 'What is the capital of Chile?', 'answer': '', 'category': 3, 'difficulty': 1}),
+        ])
+        # the categories, then one insert for the batch
+        with self.assertQueryBudget(queries=2, rows=Category.query.count()):
+            res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [{'line': 2, 'error': 'missing answer'}])
+
+    def test_bulk_import_reports_lines_that_are_not_utf8(self):
+        body = b'\xff\xfe{bad\n' + json.dumps(
+            {'question': 'What is the capital of Peru?', 'answer': 'Lima', 'category': 3, 'difficulty': 1}).encode('utf-8')
+        res = self.client().post('/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'], [{'line': 1, 'error': 'not valid UTF-8'}])
+
+        res = self.client().post('/questions/bulk', data=b'question,answer,category,difficulty\n\xe9t\xe9,Lima,3,1\n',
+                                 content_type='text/csv')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['errors'], [{'line': 2, 'error': 'not valid UTF-8'}])
+
+    def test_export_questions(self):
+        # a single pass over the table
+        with self.assertQueryBudget(queries=1, rows=Question.query.count()):
+            res = self.client().get('/questions/export')
+            rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Question.query.count())
+        self.assertEqual(rows, sorted(rows, key=lambda row: row['id']))
+
     # Search questions by results by term
     def test_get_question_search_with_results(self):
-        res = self.client().post('/questions/searchTerm', json={'searchTerm': 'What'})
+        self.client().post('/questions/searchTerm', json={'searchTerm': 'warm up'})
+        with self.assertQueryBudget(queries=1, rows=QUESTIONS_PER_PAGE + 1):
+            res = self.client().post('/questions/searchTerm', json={'searchTerm': 'What'})
         data = json.loads(res.data)
         
 
@@ -156,8 +702,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertEqual(len(data['questions']),8)
 
+    def test_search_index_keeps_questions_written_during_a_reload(self):
+        if not isinstance(self.app.extensions['search'], InvertedIndexSearch):
+            self.skipTest('the in-process index only serves SQLite')
+        written = Question(question='Which fish is striped like a zebra?', answer='Zebrafish', category=1, difficulty=1)
+        written.id = 1000000
+        with self.writtenDuringFirstQuery(lambda: self.app.extensions['search'].add(written)):
+            res = self.client().post('/questions/searchTerm', json={'searchTerm': 'zebra'})
+        data = json.loads(res.data)
+
+        # the index counts the question, whose row was never written
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_get_question_search_matches_answers(self):
+        res = self.client().post('/questions/searchTerm', json={'searchTerm': 'apollo'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['answer'], 'Apollo 13')
+
     def test_get_question_search_without_results(self):
-        res = self.client().post('/questions/searchTerm', json={'searchTerm': 'rdcdrdc'})
+        self.client().post('/questions/searchTerm', json={'searchTerm': 'warm up'})
+        with self.assertQueryBudget(queries=1, rows=0):
+            res = self.client().post('/questions/searchTerm', json={'searchTerm': 'rdcdrdc'})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -165,9 +735,40 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 0)
         self.assertEqual(len(data['questions']), 0)
 
+    def test_suggest_questions_by_prefix(self):
+        # answered from the prefix index once it is loaded
+        self.client().get('/questions/suggest?prefix=warm')
+        with self.assertQueryBudget(queries=0, rows=0):
+            res = self.client().get('/questions/suggest?prefix=pean')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['suggestions'][0]['question'], 'Who invented Peanut Butter?')
+
+    def test_suggest_keeps_questions_written_during_a_reload(self):
+        written = Question(question='Which fish is striped like a zebra?', answer='Zebrafish', category=1, difficulty=1)
+        written.id = 1000000
+        with self.writtenDuringFirstQuery(lambda: self.app.extensions['suggest'].add(written)):
+            res = self.client().get('/questions/suggest?prefix=zebra')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([suggestion['id'] for suggestion in data['suggestions']], [written.id])
+
+    def test_400_suggest_questions_without_prefix(self):
+        with self.assertQueryBudget(queries=0, rows=0):
+            res = self.client().get('/questions/suggest')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     #Search questions by question category and error
     def test_questions_in_category_search(self):
-        res = self.client().get('/categories/1/questions')
+        with self.assertQueryBudget(queries=3, rows=Category.query.count() + 1 + QUESTIONS_PER_PAGE + 1):
+            res = self.client().get('/categories/1/questions')
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
@@ -175,7 +776,8 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['current_category'], 'Science')
     
     def test_questions_in_category_not_found(self):
-        res = self.client().get('/categories/100/questions')
+        with self.assertQueryBudget(queries=1, rows=Category.query.count()):
+            res = self.client().get('/categories/100/questions')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -188,7 +790,9 @@ class TriviaTestCase(unittest.TestCase):
             'previous_questions': [2, 4, 6],
             'quiz_category': {'type': 'Entertainment', 'id': 5}
         }
-        res = self.client().post('/quizzes', json=new_quiz)
+        # the ids of the category, and no question row once all are seen
+        with self.assertQueryBudget(queries=1, rows=Question.query.filter_by(category=5).count()):
+            res = self.client().post('/quizzes', json=new_quiz)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -202,16 +806,278 @@ class TriviaTestCase(unittest.TestCase):
             'quiz_category': {'type': 'Culture', 'id': 1}
         }
 
-        res = self.client().post('/quizzes', json=new_quiz)
+        self.client().post('/quizzes', json=new_quiz)
+        # a question drawn from the loaded ids costs one primary key lookup
+        with self.assertQueryBudget(queries=1, rows=1):
+            res = self.client().post('/quizzes', json=new_quiz)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
 
+    def test_play_quiz_skips_previous_questions(self):
+        category_ids = [question.id for question in Question.query.filter_by(category=1)]
+        new_quiz = {
+            'previous_questions': category_ids[1:],
+            'quiz_category': {'type': 'Science', 'id': 1}
+        }
+        res = self.client().post('/quizzes', json=new_quiz)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], category_ids[0])
+
+    def test_play_quiz_session(self):
+        # the purge of expired sessions and the insert
+        with self.assertQueryBudget(queries=2, rows=0):
+            res = self.client().post('/quizzes/sessions', json={'quiz_category': {'type': 'Entertainment', 'id': 5}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        session_id = data['session_id']
+
+        category_questions = Question.query.filter_by(category=5).count()
+        played = []
+        for _ in range(category_questions):
+            # the session, the ids of the category on the first round, the question and the update
+            with self.assertQueryBudget(queries=3 if played else 4, rows=2 + (0 if played else category_questions)):
+                res = self.client().post('/quizzes/sessions/{}/next'.format(session_id))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            played.append(data['question']['id'])
+
+        res = self.client().post('/quizzes/sessions/{}/next'.format(session_id))
+        data = json.loads(res.data)
+        self.assertEqual(len(set(played)), len(played))
+        self.assertIsNone(data['question'])
+        self.assertEqual(data['rounds'], len(played))
+
+    def test_play_adaptive_quiz_session(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'click', 'id': 0}, 'adaptive': True, 'difficulty': 1})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['difficulty'], 1)
+        session_id = data['session_id']
+
+        difficulties = {question.id: question.difficulty for question in Question.query.all()}
+        rounds = 6
+        played = []
+        # each round reads the session and the question and updates the
+        # session, and the ids of every difficulty are loaded at most once
+        with self.assertQueryBudget(queries=3 * rounds + len(DIFFICULTIES),
+                                    rows=2 * rounds + len(difficulties)):
+            for round in range(rounds):
+                body = {'correct': True} if played else {}
+                res = self.client().post('/quizzes/sessions/{}/next'.format(session_id), json=body)
+                data = json.loads(res.data)
+                self.assertEqual(res.status_code, 200)
+
+                target = min(1 + round, DIFFICULTIES[-1])
+                self.assertEqual(data['difficulty'], target)
+                nearest = min(abs(difficulty - target)
+                              for question_id, difficulty in difficulties.items() if question_id not in played)
+                self.assertEqual(abs(data['question']['difficulty'] - target), nearest)
+                played.append(data['question']['id'])
+
+        res = self.client().post('/quizzes/sessions/{}/next'.format(session_id), json={'correct': False})
+        data = json.loads(res.data)
+        self.assertEqual(data['difficulty'], DIFFICULTIES[-1] - 1)
+        self.assertNotIn(data['question']['id'], played)
+
+    def test_422_adaptive_quiz_session_with_invalid_difficulty(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'id': 0}, 'adaptive': True, 'difficulty': 9})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_adaptive_quiz_round_cost_does_not_grow_with_bank_size(self):
+        def round_seconds(bank_size):
+            pool = QuizPool()
+            # every question of the bank but none at the target, so each
+            # round walks all the difficulties
+            for difficulty in DIFFICULTIES[:-1]:
+                pool.load(None, range(difficulty, bank_size, len(DIFFICULTIES)), difficulty)
+            pool.load(None, [], DIFFICULTIES[-1])
+            seen = SeenBitmap()
+            for question_id in range(0, 500, 7):
+                seen.add(question_id)
+
+            best = None
+            for _ in range(3):
+                started = time.perf_counter()
+                for _ in range(2000):
+                    question_id, difficulty = pool.draw_near(None, seen, DIFFICULTIES[-1])
+                    self.assertEqual(difficulty, DIFFICULTIES[-2])
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+
+        small, large = round_seconds(1000), round_seconds(1000000)
+        # a round scanning its candidates would take about 1000 times longer
+        self.assertLess(large, small * 5)
+
+    def test_quiz_pool_draws_while_other_threads_discard(self):
+        pool = QuizPool()
+        ids = pool.load(None, range(1, 2001))
+        errors = []
+
+        def draw():
+            try:
+                for _ in range(2000):
+                    question_id = pool.draw(ids, set())
+                    self.assertTrue(question_id is None or 1 <= question_id <= 2000)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=draw) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for question_id in range(1, 2000):
+            pool.discard(question_id)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(pool.draw(ids, set()), 2000)
+        ids.add(5)
+        self.assertIn(5, ids)
+        self.assertNotIn(6, ids)
+
+    def test_quiz_session_round_replayed_when_another_round_was_played_meanwhile(self):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': {'id': 1}})
+        session_id = json.loads(res.data)['session_id']
+        category_ids = {question.id for question in Question.query.filter_by(category=1)}
+        second_id = sorted(category_ids)[1]
+
+        with self.app.app_context():
+            session = load_session(session_id)
+            db.session.expunge(session)
+            # a concurrent request serves every question of the category but
+            # one, and commits before the round below
+            seen = SeenBitmap()
+            for question_id in category_ids - {second_id}:
+                seen.add(question_id)
+            self.connection.execute(QuizSession.__table__.update().where(QuizSession.id == session_id).values(
+                seen=seen.to_bytes(), rounds=len(category_ids) - 1))
+            db.session.commit()
+            db.session.add(session)
+
+            played = next_in_session(self.app.extensions['quiz_pool'], session, 3600)
+
+        self.assertEqual(played['question']['id'], second_id)
+        self.assertEqual(played['rounds'], len(category_ids))
+
+    def test_404_play_quiz_unknown_session(self):
+        with self.assertQueryBudget(queries=1, rows=0):
+            res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    @unittest.skipUnless(importlib.util.find_spec('asgiref') and importlib.util.find_spec('asyncpg' if on_postgres else 'aiosqlite'),
+                         'the ASGI mode needs asgiref, and asyncpg or aiosqlite')
+    def test_play_quiz_session_over_asgi(self):
+        from flaskr.asgi import create_asgi_app
+        category_questions = Question.query.filter_by(category=1).count()
+
+        async def post(asgi_app, path, body):
+            messages = [{'type': 'http.request', 'body': json.dumps(body).encode('utf-8')}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await asgi_app({'type': 'http', 'method': 'POST', 'path': path, 'headers': []}, receive, send)
+            return sent[0]['status'], json.loads(sent[1]['body'])
+
+        async def play(asgi_app):
+            status, data = await post(asgi_app, '/quizzes/sessions', {'quiz_category': {'id': 1}})
+            self.assertEqual(status, 201)
+            played = []
+            for _ in range(category_questions):
+                status, round_data = await post(asgi_app, '/quizzes/sessions/{}/next'.format(data['session_id']), {})
+                self.assertEqual(status, 200)
+                played.append(round_data['question']['id'])
+            status, over = await post(asgi_app, '/quizzes/sessions/{}/next'.format(data['session_id']), {})
+
+            status, adaptive = await post(asgi_app, '/quizzes/sessions', {
+                'quiz_category': {'id': 0}, 'adaptive': True, 'difficulty': 2})
+            status, round_data = await post(asgi_app, '/quizzes/sessions/{}/next'.format(adaptive['session_id']),
+                                            {'correct': True})
+            self.assertEqual((status, round_data['difficulty']), (200, 3))
+            status, batch = await post(asgi_app, '/quizzes', {
+                'previous_questions': [], 'quiz_category': {'id': 1}, 'count': category_questions})
+            self.assertEqual((status, len(batch['questions'])), (200, category_questions))
+            status, invalid = await post(asgi_app, '/quizzes/sessions', {
+                'quiz_category': {'id': 0}, 'adaptive': True, 'difficulty': 9})
+            self.assertEqual(status, 422)
+            status, unknown = await post(asgi_app, '/quizzes/sessions/unknown/next', {})
+            self.assertEqual(status, 404)
+
+            await asgi_app.engine.dispose()
+            return played, over
+
+        with tempfile.TemporaryDirectory() as tmp, self.outsideTestTransaction():
+            database_path = self.database_path
+            if not on_postgres:
+                # the async engine cannot reach the in-memory database of the tests
+                database_path = 'sqlite:///' + os.path.join(tmp, 'asgi.db')
+                create_test_app(database_path)
+            played, over = asyncio.run(play(create_asgi_app({'SQLALCHEMY_DATABASE_URI': database_path})))
+
+        self.assertEqual(len(set(played)), len(played))
+        self.assertEqual(over['question'], None)
+        self.assertEqual(over['rounds'], len(played))
+
+    def test_play_quiz_prefetches_questions(self):
+        category_questions = Question.query.filter_by(category=1).count()
+        new_quiz = {
+            'previous_questions': [],
+            'quiz_category': {'type': 'Science', 'id': 1},
+            'count': category_questions
+        }
+        # the ids of the category, then the questions drawn in one query
+        with self.assertQueryBudget(queries=2, rows=2 * category_questions):
+            res = self.client().post('/quizzes', json=new_quiz)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        questions = data['questions']
+        self.assertEqual(len(questions), category_questions)
+        self.assertEqual(len({question['id'] for question in questions}), category_questions)
+        self.assertTrue(all(question['category'] == 1 for question in questions))
+        self.assertEqual(data['question'], questions[0])
+
+        new_quiz['previous_questions'] = [question['id'] for question in questions[1:]]
+        with self.assertQueryBudget(queries=1, rows=1):
+            res = self.client().post('/quizzes', json=new_quiz)
+        data = json.loads(res.data)
+        self.assertEqual([question['id'] for question in data['questions']], [questions[0]['id']])
+
+    def test_422_play_quiz_with_invalid_count(self):
+        for count in (0, -1, 'five', 1000):
+            res = self.client().post('/quizzes', json={
+                'previous_questions': [], 'quiz_category': {'id': 0}, 'count': count})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 422)
+            self.assertEqual(data['success'], False)
+
     def test_422_play_quiz(self):
         new_quiz_round = {'previous_questions': []}
-        res = self.client().post('/quizzes', json=new_quiz_round)
+        with self.assertQueryBudget(queries=0, rows=0):
+            res = self.client().post('/quizzes', json=new_quiz_round)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -32,7 +32,7 @@ class FormView extends Component {
   submitQuestion = (event) => {
     event.preventDefault();
     $.ajax({
-      url: '/questions', //TODO: update request URL
+      url: '/questions?return=minimal', //TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',